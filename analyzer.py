@@ -1,11 +1,29 @@
+# pandas and matplotlib are imported where they are used, so counting and the pool workers
+# spawned by the CLI, sweep.py and the GUI (whose own toolkits load in setup_window) only load
+# OpenCV and NumPy
 import cv2
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from os import listdir, system, mkdir, path, makedirs
+from os import listdir, system, mkdir, path, makedirs, replace, remove, scandir, stat, walk
 from os.path import isfile, join
+from fnmatch import fnmatch
 import argparse
-from multiprocessing import Pool, Manager
+import contextlib
+import csv
+import re
+import hashlib
+import json
+import queue
+import signal
+import struct
+import threading
+import time
+import uuid
+from multiprocessing import Pool, Manager, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Optional: lets large uncompressed TIFFs be memory-mapped and read strip by strip.
+# Imported on first use by load_tifffile; False once it is known not to be installed.
+tifffile = None
 
 RED_MASK = "red_mask"
 RED_MASK_COUNT = "red_mask_count"
@@ -14,6 +32,52 @@ WHITE_MASK_COUNT = "white_mask_count"
 ORIGINAL = "original"
 HSV = "hsv"
 
+RESULTS_CSV = "PSR_results.csv"
+RESULTS_PARTIAL_CSV = "PSR_results.partial.csv"
+RESULTS_CACHE = "PSR_cache.jsonl"
+RESCORED_CSV = "PSR_rescored.csv"
+HISTOGRAMS_DIR = "histograms"
+TRACE_CSV = "PSR_trace.csv"
+MANIFEST_CSV = "PSR_manifest.csv"
+MANIFEST_COLUMNS = ["path", "size", "mtime_ns"]
+# Extensions of every image format the analyzer reads
+IMAGE_FORMATS = [".jpg", ".jpeg", ".png", ".tif", ".tiff"]
+RESULT_COLUMNS = [
+    "filename",
+    "red_pixel_count",
+    "non_tissue_pixel_count",
+    "total_pixel_count",
+    "percent_red",
+]
+# Results of an approximate run also report the estimated error of percent_red
+APPROXIMATE_RESULT_COLUMNS = RESULT_COLUMNS + ["percent_red_error"]
+# Per-image trace written with run(trace=True): sizes, then wall time in seconds per stage.
+# Stages prefixed writer_ are the writer stage rebuilding the images it saves.
+TRACE_COLUMNS = [
+    "filename",
+    "width",
+    "height",
+    "bytes_read",
+    "bytes_written",
+    "decode_s",
+    "convert_s",
+    "mask_s",
+    "count_s",
+    "histogram_s",
+    "save_histogram_s",
+    "count_total_s",
+    "writer_decode_s",
+    "writer_convert_s",
+    "writer_mask_s",
+    "writer_count_s",
+    "images_s",
+    "save_images_s",
+    "plot_s",
+    "writer_total_s",
+]
+# Trace columns only the writer stage records, which keep their names in the trace
+WRITER_STAGES = ["bytes_written", "images_s", "save_images_s", "plot_s"]
+
 """
 These HSV Ranges can be modified as needed to change the mask.
 Note that only white and red are used here.
@@ -42,40 +106,432 @@ HSV_RANGES = {
     "white": [{"lower": np.array([6, 0, 145]), "upper": np.array([46, 40, 245])}],
 }
 
+# HSV values whose gray conversion is 0, i.e. masked pixels the legacy gray count skipped
+DARK_HSV_RANGES = [
+    (np.array([0, 0, 0]), np.array([4, 0, 0])),
+    (np.array([0, 0, 1]), np.array([1, 0, 1])),
+]
+
+# Upper bound on filenames sent to a counting worker per task
+MAX_CHUNKSIZE = 32
+
+# Approximate peak memory of counting one image, in bytes per pixel: the decoded image, HSV
+# image, masks and temporaries when counting whole images; only the decoded image in tiled,
+# histogram and sampled modes, which add strip buffers per pixel of a strip
+COUNT_BYTES_PER_PIXEL = 10
+DECODED_BYTES_PER_PIXEL = 3
+STRIP_BYTES_PER_PIXEL = 12
+
+# Batch settings and reusable buffers seen by a counting worker, see init_worker and
+# batch_settings. Thread-local so every worker of the thread engine keeps its own.
+worker_state = threading.local()
+# Counting workers: separate processes, or threads of this process sharing the compiled
+# settings (OpenCV releases the GIL while decoding, converting and masking)
+WORKER_TYPES = ["process", "thread"]
+
+# Default number of processes saving review images and plots alongside the counting pool
+WRITER_PROCESSES = 2
+# Watch mode: seconds between scans of the watched folder, and seconds a file's size and mtime
+# must stay unchanged before it is considered fully written
+WATCH_POLL_SECONDS = 2
+WATCH_SETTLE_SECONDS = 5
+# Default number of counted images that may wait for the writers before counting pauses
+ARTIFACT_QUEUE_SIZE = 256
+
+# Summary plot renderers: the matplotlib figure or the faster OpenCV montage
+PLOT_RENDERERS = ["matplotlib", "montage"]
+# Default width in pixels of montage summary plots
+MONTAGE_WIDTH = 1600
+
+# Review artifact formats: the six full-size images, or one archive of the two bit-packed masks
+ARTIFACT_FORMATS = ["images", "masks"]
+MASK_ARCHIVE_SUFFIX = "_masks.npz"
+
+# Default number of image rows classified at once in tiled mode
+TILE_ROWS = 1024
+
+# Student t quantile for a 95% interval from the four replicate samples of approximate mode
+APPROXIMATE_T_95 = 3.182
+
+# Below this many ranges, cv2.inRange per range is cheaper than the lookup-table masks
+LUT_MIN_RANGES = 6
+# Ranges sharing one set of lookup tables; bit 31 is left unused so int32 tables stay positive
+LUT_GROUP_SIZE = 31
+
 
 def get_pixel_count(
-    path_to_img_dir, filename, HSV_RANGES, original_image=None, save_files=False
+    path_to_img_dir,
+    filename,
+    HSV_RANGES,
+    original_image=None,
+    save_files=False,
+    return_images=True,
+    trace=None,
+    buffers=None,
 ):
     """
     Generates pixel counts for red stained tissue, non tissue area, total area, and the resulting percentage.
     Tissue area is quantified as total_area - non_tissue_area.
+    Counts are taken directly from the binary masks; the six display images are only built when
+    return_images is set, otherwise None is returned in their place.
+    When a trace dict is given, the image size and the time spent in each stage are added to it.
+    A buffers dict lets the HSV image, masks and scratch arrays be reused from the previous call
+    (see reuse_buffer); the arrays built from them are only valid until the next such call.
     """
-    images = dict()
+    img, img_hsv, red_pixel_area, non_tissue_area, total_area, percentage, masks = count_image(
+        path_to_img_dir, filename, HSV_RANGES, original_image, trace, buffers
+    )
+
+    images = None
+    if return_images:
+        start = start_timer(trace)
+        images = build_images(img, img_hsv, masks)
+        add_stage_time(trace, "images_s", start)
+
+    return (red_pixel_area, non_tissue_area, total_area, percentage, images)
+
+
+def count_image(
+    path_to_img_dir, filename, HSV_RANGES, original_image=None, trace=None, buffers=None
+):
+    """
+    Decodes an image (unless original_image is given) and counts it. Returns the BGR and HSV
+    images with the counts and masks of count_hsv_pixels.
+    """
+    start = start_timer(trace)
     img = (
         cv2.imread(path.join(path_to_img_dir, filename))
         if original_image is None
         else original_image
     )
+    if img is None:
+        raise ValueError(f"Could not read image {path.join(path_to_img_dir, filename)}")
+    start = add_stage_time(trace, "decode_s", start)
+    img_hsv = cv2.cvtColor(
+        img, cv2.COLOR_BGR2HSV, dst=reuse_buffer(buffers, "hsv", img.shape)
+    )
+    add_stage_time(trace, "convert_s", start)
+    if trace is not None:
+        trace["height"], trace["width"] = img.shape[:2]
+
+    return (
+        img,
+        img_hsv,
+        *count_hsv_pixels(img_hsv, HSV_RANGES, trace=trace, buffers=buffers),
+    )
+
+
+def count_hsv_pixels(img_hsv, HSV_RANGES, masks=None, trace=None, buffers=None):
+    """
+    Generates the pixel counts and percentage for an image already converted to HSV.
+    Also returns the red and white binary masks the counts were taken from; masks already
+    built for these ranges can be passed in to skip the masking pass.
+    """
+    compiled = compile_hsv_ranges(HSV_RANGES)
+    start = start_timer(trace)
+    if masks is None:
+        masks = compiled.masks(img_hsv, buffers)
+    start = add_stage_time(trace, "mask_s", start)
+    counts = compiled.counts(img_hsv, masks, buffers)
+    add_stage_time(trace, "count_s", start)
+
+    red_pixel_area = counts["red"]
+    non_tissue_area = counts["white"]
+    total_area = img_hsv.shape[0] * img_hsv.shape[1]
+    percentage = red_pixel_area / (total_area - non_tissue_area)
 
-    images[ORIGINAL] = rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    images[HSV] = img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    return (red_pixel_area, non_tissue_area, total_area, percentage, masks)
 
-    mask_red = create_mask(img_hsv, ["red"], HSV_RANGES)
-    images[RED_MASK] = red_mask = cv2.bitwise_and(img_hsv, img_hsv, mask=mask_red)
-    images[RED_MASK_COUNT] = red_mask_count = cv2.cvtColor(red_mask, cv2.COLOR_BGR2GRAY)
-    red_pixel_area = cv2.countNonZero(red_mask_count)
 
-    mask_white = create_mask(img_hsv, ["white"], HSV_RANGES)
-    images[WHITE_MASK] = white_mask = cv2.bitwise_and(img_hsv, img_hsv, mask=mask_white)
-    images[WHITE_MASK_COUNT] = white_mask_count = cv2.cvtColor(
-        white_mask, cv2.COLOR_BGR2GRAY
+def get_pixel_count_tiled(
+    path_to_img_dir, filename, HSV_RANGES, tile_rows=TILE_ROWS, trace=None, buffers=None
+):
+    """
+    Generates the same pixel counts as get_pixel_count while classifying the image in strips of
+    tile_rows rows, so the HSV and mask buffers are bounded by the strip size instead of the image.
+    Display images are not built in this mode; None is returned in their place.
+    """
+    compiled = compile_hsv_ranges(HSV_RANGES)
+    red_pixel_area = non_tissue_area = total_area = 0
+
+    start = start_timer(trace)
+    for strip in read_image_strips(path.join(path_to_img_dir, filename), tile_rows):
+        start = add_stage_time(trace, "decode_s", start)
+        strip_hsv = cv2.cvtColor(
+            strip, cv2.COLOR_BGR2HSV, dst=reuse_buffer(buffers, "hsv", strip.shape)
+        )
+        start = add_stage_time(trace, "convert_s", start)
+        masks = compiled.masks(strip_hsv, buffers)
+        start = add_stage_time(trace, "mask_s", start)
+        counts = compiled.counts(strip_hsv, masks, buffers)
+        red_pixel_area += counts["red"]
+        non_tissue_area += counts["white"]
+        total_area += strip_hsv.shape[0] * strip_hsv.shape[1]
+        start = add_stage_time(trace, "count_s", start)
+
+    percentage = red_pixel_area / (total_area - non_tissue_area)
+    if trace is not None:
+        trace["width"] = strip.shape[1]
+        trace["height"] = total_area // strip.shape[1]
+
+    return (red_pixel_area, non_tissue_area, total_area, percentage, None)
+
+
+def get_pixel_count_sampled(
+    path_to_img_dir, filename, HSV_RANGES, sample_step, trace=None
+):
+    """
+    Estimates the pixel counts of get_pixel_count from four interleaved grids of pixels, each
+    taking every sample_step-th pixel of every sample_step-th row (offset by half a step), so
+    only 4 / sample_step**2 of the image is converted and classified. Uncompressed TIFFs are
+    memory-mapped so only the sampled rows are read.
+    Returns (red_pixel_area, non_tissue_area, total_area, percentage, percentage_error), where
+    the areas are scaled up to the whole image and percentage_error is the half-width of a 95%
+    confidence interval estimated from the spread between the four grids.
+    """
+    compiled = compile_hsv_ranges(HSV_RANGES)
+    path_to_image = path.join(path_to_img_dir, filename)
+    start = start_timer(trace)
+    image = memmap_tiff(path_to_image)
+    if image is None:
+        image = cv2.imread(path_to_image)
+        if image is None:
+            raise ValueError(f"Could not read image {path_to_image}")
+    else:
+        # TIFF samples are stored RGB; reverse to match cv2.imread
+        image = image[:, :, ::-1]
+
+    half_step = sample_step // 2
+    replicates = []
+    for row, column in [(0, 0), (0, half_step), (half_step, 0), (half_step, half_step)]:
+        start = add_stage_time(trace, "decode_s", start)
+        sample = np.ascontiguousarray(image[row::sample_step, column::sample_step])
+        sample_hsv = cv2.cvtColor(sample, cv2.COLOR_BGR2HSV)
+        start = add_stage_time(trace, "convert_s", start)
+        masks = compiled.masks(sample_hsv)
+        start = add_stage_time(trace, "mask_s", start)
+        counts = compiled.counts(sample_hsv, masks)
+        replicates.append(
+            (counts["red"], counts["white"], sample_hsv.shape[0] * sample_hsv.shape[1])
+        )
+        start = add_stage_time(trace, "count_s", start)
+
+    red, white, sampled = np.array(replicates).T
+    total_area = image.shape[0] * image.shape[1]
+    red_pixel_area = int(round(red.sum() * total_area / sampled.sum()))
+    non_tissue_area = int(round(white.sum() * total_area / sampled.sum()))
+    percentage = red.sum() / (sampled.sum() - white.sum())
+
+    tissue = sampled - white
+    if (tissue > 0).all():
+        standard_error = np.std(red / tissue, ddof=1) / np.sqrt(len(replicates))
+        percentage_error = APPROXIMATE_T_95 * standard_error
+    else:
+        percentage_error = float("nan")
+    if trace is not None:
+        trace["height"], trace["width"] = image.shape[:2]
+
+    return (
+        red_pixel_area,
+        non_tissue_area,
+        total_area,
+        float(percentage),
+        float(percentage_error),
     )
 
-    non_tissue_area = cv2.countNonZero(white_mask_count)
-    total_area = red_mask_count.shape[0] * red_mask_count.shape[1]
+
+def read_image_strips(path_to_image, tile_rows=TILE_ROWS):
+    """
+    Yields the image as consecutive BGR strips of at most tile_rows rows.
+    Uncompressed 8-bit RGB TIFFs are memory-mapped (when tifffile is installed) so only the strip
+    being classified is paged in; any other file is decoded with cv2.imread and sliced.
+    """
+    image = memmap_tiff(path_to_image)
+    if image is None:
+        image = cv2.imread(path_to_image)
+        if image is None:
+            raise ValueError(f"Could not read image {path_to_image}")
+        for row in range(0, image.shape[0], tile_rows):
+            yield image[row : row + tile_rows]
+        return
+
+    for row in range(0, image.shape[0], tile_rows):
+        # TIFF samples are stored RGB; reverse to match cv2.imread
+        yield np.ascontiguousarray(image[row : row + tile_rows, :, ::-1])
+
+
+def load_tifffile():
+    """
+    Imports the optional tifffile package the first time a TIFF needs it. Returns None when it
+    is not installed.
+    """
+    global tifffile
+    if tifffile is None:
+        try:
+            import tifffile as module
+        except ImportError:
+            module = False
+        tifffile = module
+
+    return tifffile or None
+
+
+def memmap_tiff(path_to_image):
+    """
+    Returns a read-only memory map of the first page of a TIFF if it can be read exactly as
+    cv2.imread would read it, otherwise None.
+    """
+    if path.splitext(path_to_image)[1].lower() not in [".tif", ".tiff"]:
+        return None
+    tifffile = load_tifffile()
+    if tifffile is None:
+        return None
+
+    try:
+        with tifffile.TiffFile(path_to_image) as tif:
+            page = tif.pages[0]
+            orientation = page.tags.get(274)
+            if not (
+                page.is_memmappable
+                and page.dtype == np.uint8
+                and len(page.shape) == 3
+                and page.shape[2] == 3
+                and page.photometric == tifffile.PHOTOMETRIC.RGB
+                and (orientation is None or orientation.value == 1)
+            ):
+                return None
+        return tifffile.memmap(path_to_image, page=0, mode="r")
+    except (ValueError, tifffile.TiffFileError):
+        return None
+
+
+def compute_hsv_histogram(path_to_image, tile_rows=TILE_ROWS, trace=None):
+    """
+    Returns the exact HSV histogram of an image as (codes, counts) for its non-empty bins, where
+    code = h << 16 | s << 8 | v. The image is converted strip by strip to bound memory, and only
+    the colors that occur are accumulated.
+    """
+    codes = np.empty(0, dtype=np.uint32)
+    counts = np.empty(0, dtype=np.uint64)
+    start = start_timer(trace)
+    for strip in read_image_strips(path_to_image, tile_rows):
+        start = add_stage_time(trace, "decode_s", start)
+        strip_hsv = cv2.cvtColor(strip, cv2.COLOR_BGR2HSV)
+        start = add_stage_time(trace, "convert_s", start)
+        strip_codes = (
+            (strip_hsv[..., 0].astype(np.uint32) << 16)
+            | (strip_hsv[..., 1].astype(np.uint32) << 8)
+            | strip_hsv[..., 2]
+        )
+        strip_codes, strip_counts = np.unique(strip_codes, return_counts=True)
+        codes, counts = merge_histograms(
+            np.concatenate([codes, strip_codes]),
+            np.concatenate([counts, strip_counts.astype(np.uint64)]),
+        )
+        start = add_stage_time(trace, "histogram_s", start)
+
+    if trace is not None:
+        trace["width"] = strip.shape[1]
+        trace["height"] = int(counts.sum()) // strip.shape[1]
+    return codes, counts
+
+
+def merge_histograms(codes, counts):
+    """
+    Sums the counts of repeated codes, returning sorted unique (codes, counts).
+    """
+    order = np.argsort(codes, kind="stable")
+    codes, counts = codes[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+    return codes[starts], np.add.reduceat(counts, starts)
+
+
+def count_histogram(codes, counts, HSV_RANGES):
+    """
+    Generates the same pixel counts as get_pixel_count from an image's HSV histogram, without
+    touching the image. Each bin is classified once by treating the bins as a 1-row HSV image.
+    """
+    compiled = compile_hsv_ranges(HSV_RANGES)
+    bins_hsv = np.stack(
+        [codes >> 16, (codes >> 8) & 255, codes & 255], axis=-1
+    ).astype(np.uint8)[np.newaxis]
+    masks = compiled.masks(bins_hsv)
+
+    # Near-black values are not counted, matching the gray-image counts
+    counted = np.ones(len(codes), dtype=bool)
+    for lower, upper in DARK_HSV_RANGES:
+        counted &= cv2.inRange(bins_hsv, lower, upper)[0] == 0
+
+    red_pixel_area = int(counts[(masks["red"][0] > 0) & counted].sum())
+    non_tissue_area = int(counts[(masks["white"][0] > 0) & counted].sum())
+    total_area = int(counts.sum())
     percentage = red_pixel_area / (total_area - non_tissue_area)
 
-    return (red_pixel_area, non_tissue_area, total_area, percentage, images)
+    return (red_pixel_area, non_tissue_area, total_area, percentage)
+
+
+def histogram_path(histogram_dir, filename):
+    return path.join(histogram_dir, f"{filename}.npz")
+
+
+def rescore(results_dir, hsv_ranges, output_csv=None):
+    """
+    Recomputes the results for new HSV ranges from the histogram sidecars saved by
+    run(save_histograms=True), without decoding any image. Writes PSR_rescored.csv in
+    results_dir unless output_csv is given.
+    """
+    hsv_ranges = compile_hsv_ranges(hsv_ranges)
+    histogram_dir = path.join(results_dir, HISTOGRAMS_DIR)
+
+    rows = []
+    for dirpath, _, files in walk(histogram_dir):
+        for name in files:
+            if not name.endswith(".npz"):
+                continue
+            # Results name nested images with "/" on every platform, like discover_images
+            relative_path = path.relpath(path.join(dirpath, name), histogram_dir)
+            filename = relative_path.replace(path.sep, "/")[: -len(".npz")]
+            with np.load(path.join(dirpath, name)) as histogram:
+                rows.append(
+                    [filename, *count_histogram(histogram["codes"], histogram["counts"], hsv_ranges)]
+                )
+
+    write_results_csv(
+        output_csv if output_csv else path.join(results_dir, RESCORED_CSV), sorted(rows), RESULT_COLUMNS
+    )
+    print("Done!")
+
+
+def load_settings(settings_path):
+    """
+    Loads the HSV ranges from a settings JSON saved by the GUI (see sample_settings.json).
+    """
+    with open(settings_path) as f:
+        settings = json.load(f)
+
+    return {
+        color: [
+            {"lower": np.array(r["lower"]), "upper": np.array(r["upper"])} for r in ranges
+        ]
+        for color, ranges in settings["hsv_ranges"].items()
+    }
+
+
+def build_images(img, img_hsv, masks):
+    """
+    Builds the six review images (original, HSV, masked HSV and their gray count images).
+    """
+    images = dict()
+    images[ORIGINAL] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    images[HSV] = img_hsv
+    images[RED_MASK] = red_mask = cv2.bitwise_and(img_hsv, img_hsv, mask=masks["red"])
+    images[RED_MASK_COUNT] = cv2.cvtColor(red_mask, cv2.COLOR_BGR2GRAY)
+    images[WHITE_MASK] = white_mask = cv2.bitwise_and(
+        img_hsv, img_hsv, mask=masks["white"]
+    )
+    images[WHITE_MASK_COUNT] = cv2.cvtColor(white_mask, cv2.COLOR_BGR2GRAY)
+
+    return images
 
 
 def generate_plot(
@@ -93,6 +549,8 @@ def generate_plot(
     """
     Generates a plot with all 6 images used for analysis with resulting pixel counts and percentages.
     """
+    import matplotlib.pyplot as plt
+
     fig, axs = plt.subplots(3, 2, figsize=(18, 18))
     fig.suptitle(f"Image: {filename}", fontsize=18, fontweight="bold")
     fig.text(
@@ -124,11 +582,90 @@ def generate_plot(
     plt.close()
 
 
+def generate_montage(
+    images,
+    filename,
+    total_area,
+    red_pixel_area,
+    non_tissue_area,
+    percentage,
+    path_to_new_folder,
+    save_extension=".tif",
+    montage_width=MONTAGE_WIDTH,
+):
+    """
+    Fast alternative to generate_plot: downsamples the 6 images into a 3x2 montage with the same
+    titles and pixel counts using OpenCV only, and saves it montage_width pixels wide.
+    """
+    panels = [
+        (images[ORIGINAL], "Original image"),
+        (images[HSV], "HSV image"),
+        (images[RED_MASK], "HSV image with red mask"),
+        (images[RED_MASK_COUNT], "Converted image for pixel count"),
+        (images[WHITE_MASK], "Non-tissue mask"),
+        (images[WHITE_MASK_COUNT], "Non-tissue image for pixel count"),
+    ]
+    height, width = images[ORIGINAL].shape[:2]
+    panel_width = montage_width // 2
+    panel_height = max(1, round(height * panel_width / width))
+    scale = montage_width / 1000
+    title_height = int(60 * scale)
+    label_height = int(30 * scale)
+    footer_height = int(50 * scale)
+
+    montage = np.full(
+        (
+            title_height + 3 * (label_height + panel_height) + footer_height,
+            2 * panel_width,
+            3,
+        ),
+        255,
+        dtype=np.uint8,
+    )
+    for i, (image, text) in enumerate(panels):
+        # Panels are shown the way matplotlib would display them, i.e. as RGB
+        panel = cv2.resize(image, (panel_width, panel_height), interpolation=cv2.INTER_AREA)
+        panel = (
+            cv2.cvtColor(panel, cv2.COLOR_GRAY2BGR)
+            if panel.ndim == 2
+            else cv2.cvtColor(panel, cv2.COLOR_RGB2BGR)
+        )
+        x = (i % 2) * panel_width
+        y = title_height + (i // 2) * (label_height + panel_height)
+        put_text(montage, text, (x + int(10 * scale), y + int(22 * scale)), 0.6 * scale, 1)
+        y += label_height
+        montage[y : y + panel_height, x : x + panel_width] = panel
+
+    put_text(montage, f"Image: {filename}", (int(10 * scale), int(40 * scale)), scale, 2)
+    put_text(
+        montage,
+        f"TOTAL PIXELS: {total_area}; RED PIXELS: {red_pixel_area}; NON-TISSUE PIXELS: {non_tissue_area}; PERCENT RED: {percentage:f}",
+        (int(10 * scale), montage.shape[0] - int(18 * scale)),
+        0.5 * scale,
+        1,
+    )
+
+    save_img(montage, f"{filename}_plot{save_extension}", path_to_new_folder)
+
+
+def put_text(img, text, origin, font_scale, thickness):
+    cv2.putText(
+        img,
+        text,
+        origin,
+        cv2.FONT_HERSHEY_SIMPLEX,
+        font_scale,
+        (0, 0, 0),
+        max(1, round(thickness * font_scale)),
+        cv2.LINE_AA,
+    )
+
+
 def save_images(images, path_to_new_folder, filename, save_extension=".tif"):
     """
     Persists generated images for review.
     """
-    base_filename = path.splitext(filename)[0]
+    base_filename = path.splitext(path.basename(filename))[0]
     for key, image in images.items():
         save_img(
             cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
@@ -137,19 +674,225 @@ def save_images(images, path_to_new_folder, filename, save_extension=".tif"):
         )
 
 
+def save_mask_archive(masks, path_to_new_folder, filename, settings_digest=None):
+    """
+    Saves the red and white masks of an image bit-packed into one compressed archive, a small
+    fraction of the size of the six review images, which load_review_images rebuilds on demand.
+    The digest of the ranges that produced the masks is stored alongside them for auditing.
+    """
+    shape = masks["red"].shape
+    np.savez_compressed(
+        path.join(
+            path_to_new_folder, f"{path.splitext(path.basename(filename))[0]}{MASK_ARCHIVE_SUFFIX}"
+        ),
+        shape=np.array(shape),
+        red=np.packbits(masks["red"] > 0),
+        white=np.packbits(masks["white"] > 0),
+        settings=np.array(settings_digest or ""),
+    )
+
+
+def load_masks(archive_path):
+    """
+    Loads the red and white masks (0 or 255) saved by save_mask_archive.
+    """
+    with np.load(archive_path) as archive:
+        shape = tuple(archive["shape"])
+        return {
+            color: np.unpackbits(archive[color], count=shape[0] * shape[1]).reshape(shape) * 255
+            for color in ["red", "white"]
+        }
+
+
+def load_review_images(archive_path, path_to_image, keys=None):
+    """
+    Rebuilds review images from a mask archive and the original image it was made from.
+    Returns the six images of build_images, or only the given keys (e.g. [RED_MASK]).
+    """
+    masks = load_masks(archive_path)
+    img = cv2.imread(path_to_image)
+    if img is None:
+        raise ValueError(f"Could not read image {path_to_image}")
+    if img.shape[:2] != masks["red"].shape:
+        raise ValueError(f"{path_to_image} does not match the masks in {archive_path}")
+
+    images = build_images(img, cv2.cvtColor(img, cv2.COLOR_BGR2HSV), masks)
+    return images if keys is None else {key: images[key] for key in keys}
+
+
 def create_mask(hsv_img, colors, HSV_RANGES):
     """
     Creates a binary mask from HSV image using given colors.
     """
+    compiled = compile_hsv_ranges(HSV_RANGES, colors)
+    masks = compiled.masks(hsv_img)
     mask = np.zeros((hsv_img.shape[0], hsv_img.shape[1]), dtype=np.uint8)
-
     for color in colors:
-        for color_range in HSV_RANGES[color]:
-            mask += cv2.inRange(hsv_img, color_range["lower"], color_range["upper"])
+        cv2.bitwise_or(mask, masks[color], dst=mask)
 
     return mask
 
 
+class CompiledRanges:
+    """
+    HSV ranges compiled once per batch so every color mask is decided in a single pass.
+
+    Each range is assigned one bit, and a 256-entry lookup table per channel records which
+    ranges accept each channel value. A pixel belongs to a range when that range's bit is set
+    in all three channel lookups, so the cost of classifying an image no longer grows with the
+    number of ranges. With only a few ranges, plain cv2.inRange calls are cheaper than the
+    lookups and are used instead.
+    """
+
+    def __init__(self, hsv_ranges, colors=("red", "white")):
+        self.colors = tuple(colors)
+        self.ranges = {
+            color: [
+                (np.rint(r["lower"]).astype(int), np.rint(r["upper"]).astype(int))
+                for r in hsv_ranges.get(color, [])
+            ]
+            for color in self.colors
+        }
+        self.dark_colors = {
+            color
+            for color in self.colors
+            for lower, upper in self.ranges[color]
+            for dark_lower, dark_upper in DARK_HSV_RANGES
+            if (lower <= dark_upper).all() and (upper >= dark_lower).all()
+        }
+        tagged = [
+            (color, lower, upper)
+            for color in self.colors
+            for lower, upper in self.ranges[color]
+        ]
+        self.groups = []
+        if len(tagged) >= LUT_MIN_RANGES:
+            values = np.arange(256)
+            for start in range(0, len(tagged), LUT_GROUP_SIZE):
+                group = tagged[start : start + LUT_GROUP_SIZE]
+                dtype = (
+                    np.uint8 if len(group) <= 8 else np.uint16 if len(group) <= 16 else np.int32
+                )
+                luts = np.zeros((3, 256), dtype=dtype)
+                bits = dict()
+                for bit, (color, lower, upper) in enumerate(group):
+                    for channel in range(3):
+                        accepted = (values >= lower[channel]) & (values <= upper[channel])
+                        luts[channel, accepted] |= dtype(1 << bit)
+                    bits[color] = bits.get(color, 0) | (1 << bit)
+                self.groups.append((luts, bits))
+
+    def digest(self):
+        """
+        Returns a hash of the effective ranges, used to tell whether cached results still apply.
+        """
+        effective = {
+            color: [[lower.tolist(), upper.tolist()] for lower, upper in self.ranges[color]]
+            for color in self.colors
+        }
+        return hashlib.sha256(json.dumps(effective, sort_keys=True).encode()).hexdigest()
+
+    def counts(self, hsv_img, masks, buffers=None):
+        """
+        Returns the number of pixels in each mask.
+
+        The reported counts have always been taken from the gray conversion of the masked HSV
+        image, where a few near-black HSV values convert to 0 and are not counted. Those pixels
+        are subtracted here for colors whose ranges can reach them, keeping counts identical.
+        """
+        counts = dict()
+        for color in self.colors:
+            counts[color] = cv2.countNonZero(masks[color])
+            if color in self.dark_colors:
+                dark = reuse_buffer(buffers, "scratch", masks[color].shape)
+                for lower, upper in DARK_HSV_RANGES:
+                    cv2.inRange(hsv_img, lower, upper, dst=dark)
+                    cv2.bitwise_and(dark, masks[color], dst=dark)
+                    counts[color] -= cv2.countNonZero(dark)
+
+        return counts
+
+    def masks(self, hsv_img, buffers=None):
+        """
+        Returns a dict of binary masks (0 or 255) for every compiled color.
+        With a buffers dict, the masks and scratch arrays of the previous call are reused.
+        """
+        shape = (hsv_img.shape[0], hsv_img.shape[1])
+        masks = {color: reuse_buffer(buffers, f"mask_{color}", shape) for color in self.colors}
+        scratch = reuse_buffer(buffers, "scratch", shape)
+
+        if not self.groups:
+            for color in self.colors:
+                if not self.ranges[color]:
+                    masks[color].fill(0)
+                for i, (lower, upper) in enumerate(self.ranges[color]):
+                    if i == 0:
+                        cv2.inRange(hsv_img, lower, upper, dst=masks[color])
+                    else:
+                        cv2.inRange(hsv_img, lower, upper, dst=scratch)
+                        cv2.bitwise_or(masks[color], scratch, dst=masks[color])
+            return masks
+
+        for color in self.colors:
+            masks[color].fill(0)
+        for luts, bits in self.groups:
+            hits = reuse_buffer(buffers, f"hits_{luts.dtype}", shape, luts.dtype)
+            channel_hits = reuse_buffer(buffers, f"channel_hits_{luts.dtype}", shape, luts.dtype)
+            for channel in range(3):
+                cv2.extractChannel(hsv_img, channel, dst=scratch)
+                if channel == 0:
+                    cv2.LUT(scratch, luts[0], dst=hits)
+                else:
+                    cv2.LUT(scratch, luts[channel], dst=channel_hits)
+                    cv2.bitwise_and(hits, channel_hits, dst=hits)
+            for color, color_bits in bits.items():
+                color_hits = hits
+                if len(bits) > 1:
+                    color_hits = cv2.bitwise_and(hits, color_bits, dst=channel_hits)
+                cv2.compare(color_hits, 0, cv2.CMP_NE, dst=scratch)
+                cv2.bitwise_or(masks[color], scratch, dst=masks[color])
+
+        return masks
+
+
+def reuse_buffer(buffers, name, shape, dtype=np.uint8):
+    """
+    Returns an array of this shape and dtype backed by the buffer kept under name in buffers,
+    otherwise a new one that is kept for the next call. Without buffers, a new array is always
+    returned. A buffer with at least as many rows serves shorter shapes as a row-slice view, so
+    the short last strip of a tiled image does not replace the full-size strip buffers. Only
+    one buffer is kept per name, so memory stays flat across images of any size.
+    """
+    if buffers is None:
+        return np.empty(shape, dtype=dtype)
+
+    shape = tuple(shape)
+    buffer = buffers.get(name)
+    if (
+        buffer is None
+        or buffer.dtype != dtype
+        or buffer.shape[1:] != shape[1:]
+        or buffer.shape[0] < shape[0]
+    ):
+        buffer = buffers[name] = np.empty(shape, dtype=dtype)
+    return buffer[: shape[0]]
+
+
+def compile_hsv_ranges(hsv_ranges, colors=("red", "white")):
+    """
+    Returns compiled ranges for the given colors, reusing hsv_ranges if it is already compiled.
+    """
+    if isinstance(hsv_ranges, CompiledRanges) and set(colors) <= set(hsv_ranges.colors):
+        return hsv_ranges
+    if isinstance(hsv_ranges, CompiledRanges):
+        hsv_ranges = {
+            color: [{"lower": lower, "upper": upper} for lower, upper in ranges]
+            for color, ranges in hsv_ranges.ranges.items()
+        }
+
+    return CompiledRanges(hsv_ranges, colors)
+
+
 def clear():
     system("cls")
 
@@ -170,21 +913,714 @@ def generate_image_subdirectory_path(filename, output_dir):
     return f"{output_dir}/{foldername}"
 
 
-def process_image_worker(args):
-    path_to_img_dir, filename, hsv_ranges, output_dir, save_files, save_extension, progress_queue = args
+def start_timer(trace):
+    """
+    Returns the start time of a traced stage, or None when no trace is being recorded.
+    """
+    return time.perf_counter() if trace is not None else None
+
+
+def add_stage_time(trace, stage, start):
+    """
+    Adds the wall time since start to trace[stage] and returns the current time, so the next
+    stage can be timed from it. Does nothing when trace is None.
+    """
+    if trace is None:
+        return None
+    now = time.perf_counter()
+    trace[stage] = trace.get(stage, 0.0) + now - start
+    return now
+
+
+def write_trace(trace_path, traces, elapsed):
+    """
+    Writes the per-image traces to trace_path and prints where the batch spent its time.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(
+        [{"filename": f, **traces[f]} for f in sorted(traces)], columns=TRACE_COLUMNS
+    )
+    df.to_csv(trace_path, index=False)
+    if df.empty:
+        return
+
+    megapixels = (df["width"] * df["height"]).sum() / 1e6
+    print(
+        f"Traced {len(df)} images ({megapixels:.1f} MP, {df['bytes_read'].sum() / 2**20:.1f} MB "
+        f"read, {df['bytes_written'].sum() / 2**20:.1f} MB written) in {elapsed:.2f} s: "
+        f"{megapixels / elapsed:.1f} MP/s"
+    )
+    stages = [c for c in TRACE_COLUMNS if c.endswith("_s") and not c.endswith("total_s")]
+    totals = df[stages].sum()
+    for stage in stages:
+        if totals[stage] > 0:
+            print(
+                f"  {stage[:-2]:>16}: {totals[stage]:8.2f} s ({totals[stage] / totals.sum():6.1%}), "
+                f"{df[stage].mean() * 1000:.1f} ms/image"
+            )
+
+
+def discover_images(
+    path_to_img_dir, image_formats, recursive=False, include=None, exclude=None
+):
+    """
+    Lists the images in path_to_img_dir as (path, size, mtime_ns), with paths relative to
+    path_to_img_dir and "/"-separated. Subfolders are walked with os.scandir when recursive is
+    set; folders matching an exclude glob are not entered. See is_selected for the filters.
+    """
+    images = []
+    folders = [""]
+    while folders:
+        folder = folders.pop()
+        with scandir(path.join(path_to_img_dir, folder)) as folder_entries:
+            for dir_entry in folder_entries:
+                relative_path = f"{folder}/{dir_entry.name}" if folder else dir_entry.name
+                if recursive and dir_entry.is_dir():
+                    if not any(fnmatch(relative_path, pattern) for pattern in exclude or []):
+                        folders.append(relative_path)
+                elif is_selected(relative_path, image_formats, include, exclude):
+                    if dir_entry.is_file():
+                        file_stat = dir_entry.stat()
+                        images.append((relative_path, file_stat.st_size, file_stat.st_mtime_ns))
+
+    return sorted(images)
+
+
+def is_selected(relative_path, image_formats, include=None, exclude=None):
+    """
+    Whether an image path ends with one of image_formats (a string or a list of them, or None
+    for any), matches one of the include globs if any are given, and matches none of the
+    exclude globs.
+    """
+    if isinstance(image_formats, str):
+        image_formats = [image_formats]
+    return (
+        (image_formats is None or relative_path.endswith(tuple(image_formats)))
+        and (not include or any(fnmatch(relative_path, pattern) for pattern in include))
+        and not any(fnmatch(relative_path, pattern) for pattern in exclude or [])
+    )
+
+
+def is_within(folder, parent):
+    """
+    Whether folder is parent or one of its subfolders.
+    """
+    parent = path.abspath(parent)
+    return path.commonpath([path.abspath(folder), parent]) == parent
+
+
+def write_manifest(manifest_path, images):
+    """
+    Atomically writes the (path, size, mtime_ns) of discovered images to a manifest CSV.
+    The temporary file is unique, so several nodes may write the same shared manifest.
+    """
+    tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(MANIFEST_COLUMNS)
+        writer.writerows(images)
+    replace(tmp_path, manifest_path)
+
+
+def load_manifest(manifest_path, image_formats=None, include=None, exclude=None):
+    """
+    Loads the images of a manifest written by write_manifest that pass the given filters.
+    """
+    with open(manifest_path, newline="") as f:
+        return [
+            (row["path"], int(row["size"]), int(row["mtime_ns"]))
+            for row in csv.DictReader(f)
+            if is_selected(row["path"], image_formats, include, exclude)
+        ]
+
+
+def read_image_dimensions(path_to_image):
+    """
+    Returns the (width, height) of a PNG, JPEG or TIFF from its header, without decoding the
+    image, or None for other files.
+    """
+    with open(path_to_image, "rb") as f:
+        header = f.read(8)
+        if header == b"\x89PNG\r\n\x1a\n":
+            f.seek(16)
+            return struct.unpack(">II", f.read(8))
+
+        if header[:2] == b"\xff\xd8":
+            # Walk the JPEG segments up to the start-of-frame marker holding the dimensions
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                length = struct.unpack(">H", f.read(2))[0]
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, 1)
+
+        if header[:4] in (b"II*\x00", b"MM\x00*"):
+            # Read the width and height tags of the first image directory
+            order = "<" if header[:2] == b"II" else ">"
+            f.seek(struct.unpack(f"{order}I", header[4:8])[0])
+            tags = dict()
+            for _ in range(struct.unpack(f"{order}H", f.read(2))[0]):
+                tag, field_type, _, value = struct.unpack(f"{order}HHI4s", f.read(12))
+                if tag in (256, 257):
+                    value_format = "H" if field_type == 3 else "I"
+                    tags[tag] = struct.unpack_from(f"{order}{value_format}", value)[0]
+            if 256 in tags and 257 in tags:
+                return tags[256], tags[257]
+
+    return None
+
+
+def estimate_image_memory(
+    path_to_image, file_size, tile_rows=None, histogram=False, sample_step=None
+):
+    """
+    Estimates the peak memory in bytes of counting one image, from its header dimensions. Files
+    whose dimensions cannot be read are assumed to hold one pixel per byte.
+    """
+    dimensions = read_image_dimensions(path_to_image)
+    width, height = dimensions if dimensions is not None else (file_size, 1)
+    pixels = width * height
+
+    if sample_step:
+        return DECODED_BYTES_PER_PIXEL * pixels
+    if tile_rows or histogram:
+        strip_rows = min(tile_rows or TILE_ROWS, height)
+        return DECODED_BYTES_PER_PIXEL * pixels + STRIP_BYTES_PER_PIXEL * width * strip_rows
+    return COUNT_BYTES_PER_PIXEL * pixels
+
+
+def schedule_tasks(pool, batch_id, tasks, workers, memory_budget=None):
+    """
+    Counts the images in tasks, (filename, memory estimate) pairs sorted largest first, and
+    yields the results of process_image_worker as they complete.
+    Without a memory_budget the tasks are streamed to the pool in chunks to keep dispatch cheap.
+    The chunks are dealt round-robin from the sorted list, so each mixes large and small images
+    and the largest ones start on different workers rather than queueing behind each other. With a memory_budget in bytes, at most workers images are in flight and an image only
+    starts when its estimate fits next to the images already running, so large images wait for
+    room while smaller ones fill the idle workers; an image larger than the budget runs on its own.
+    """
+    if memory_budget is None:
+        chunksize = max(1, min(MAX_CHUNKSIZE, len(tasks) // (4 * workers)))
+        chunks = -(-len(tasks) // chunksize)
+        dealt = [
+            [(batch_id, filename) for filename, _ in tasks[chunk::chunks]] for chunk in range(chunks)
+        ]
+        for results in pool.imap_unordered(process_image_chunk, dealt):
+            yield from results
+        return
+
+    done = queue.Queue()
+    waiting = list(tasks)
+    running = reserved = 0
+    while waiting or running:
+        i = 0
+        while running < workers and i < len(waiting):
+            filename, estimate = waiting[i]
+            if running and reserved + estimate > memory_budget:
+                i += 1
+                continue
+            del waiting[i]
+            pool.apply_async(
+                process_image_worker,
+                ((batch_id, filename),),
+                callback=lambda result, estimate=estimate: done.put((estimate, result, None)),
+                error_callback=lambda error, estimate=estimate: done.put((estimate, None, error)),
+            )
+            running += 1
+            reserved += estimate
+
+        estimate, result, error = done.get()
+        running -= 1
+        reserved -= estimate
+        if error is not None:
+            raise error
+        yield result
+
+
+def in_shard(filename, shard):
+    """
+    Whether an image belongs to shard (index, count). Images are assigned by a hash of their
+    relative path, so every node computes the same partition without coordinating, and adding
+    images never moves existing ones to another shard.
+    """
+    index, count = shard
+    digest = hashlib.sha1(filename.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+
+def shard_filename(filename, shard):
+    """
+    Inserts the shard into a results file name, e.g. PSR_results.shard-0-of-4.csv, so nodes
+    sharing an output folder never write the same files. Returns filename without a shard.
+    """
+    if shard is None:
+        return filename
+    stem, ext = path.splitext(filename)
+    return f"{stem}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def merge_shards(results_dir, shard_count=None, manifest_path=None):
+    """
+    Combines the PSR_results.shard-*-of-N.csv files of a sharded run into PSR_results.csv.
+    Reports shards that have no results yet, images found in several shards (the first is kept)
+    and, against the manifest (PSR_manifest.csv by default), images no shard has counted.
+    Returns a dict of these problems; the merged file is written either way.
+    """
+    import pandas as pd
+
+    pattern = re.compile(
+        rf"^{re.escape(path.splitext(RESULTS_CSV)[0])}\.shard-(\d+)-of-(\d+)\.csv$"
+    )
+    shard_files = dict()
+    for filename in listdir(results_dir):
+        match = pattern.match(filename)
+        if match:
+            shard_files.setdefault(int(match[2]), dict())[int(match[1])] = filename
+
+    if shard_count is None:
+        if len(shard_files) != 1:
+            raise ValueError(
+                f"Found results for shard counts {sorted(shard_files)}; choose one shard count"
+            )
+        shard_count = next(iter(shard_files))
+    shard_files = shard_files.get(shard_count, dict())
+
+    frames = [
+        pd.read_csv(
+            path.join(results_dir, shard_files[index]), index_col=0, float_precision="round_trip"
+        )
+        for index in sorted(shard_files)
+    ]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=RESULT_COLUMNS)
+    duplicated = df["filename"].duplicated()
+    problems = {
+        "missing_shards": [i for i in range(shard_count) if i not in shard_files],
+        "duplicates": sorted(set(df.loc[duplicated, "filename"])),
+        "missing_files": [],
+    }
+    df = df[~duplicated].sort_values("filename").reset_index(drop=True)
+
+    manifest_path = manifest_path or path.join(results_dir, MANIFEST_CSV)
+    if path.exists(manifest_path):
+        expected = {filename for filename, _, _ in load_manifest(manifest_path)}
+        problems["missing_files"] = sorted(expected - set(df["filename"]))
+
+    csv_path = path.join(results_dir, RESULTS_CSV)
+    df.to_csv(f"{csv_path}.tmp")
+    replace(f"{csv_path}.tmp", csv_path)
+
+    print(f"Merged {len(df)} images from {len(shard_files)} of {shard_count} shards")
+    for problem, items in problems.items():
+        if items:
+            print(f"{problem.replace('_', ' ').capitalize()} ({len(items)}): {items[:20]}")
+
+    return problems
+
+
+def file_identity(file_path, hash_contents=False):
+    """
+    Identifies an image file for the results cache by size and modification time, or by a
+    hash of its bytes when hash_contents is set (e.g. for copies that do not keep mtimes).
+    """
+    if not hash_contents:
+        file_stat = stat(file_path)
+        return {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"sha256": digest.hexdigest()}
+
+
+def load_results_cache(cache_path):
+    """
+    Loads the results cache written by previous runs, keyed by filename.
+    A truncated last line left by an interrupted run is ignored.
+    """
+    cache = dict()
+    if not path.exists(cache_path):
+        return cache
+
+    with open(cache_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            cache[entry["result"][0]] = entry
+
+    return cache
+
+
+def append_results_cache(cache_file, entry):
+    """
+    Appends one finished image to the results cache opened for appending.
+    """
+    cache_file.write(json.dumps(entry) + "\n")
+    cache_file.flush()
+
+
+def write_results_cache(cache_path, entries):
+    """
+    Atomically rewrites the results cache with only the given entries.
+    """
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    replace(tmp_path, cache_path)
+
+
+def write_results_csv(csv_path, rows, columns):
+    """
+    Atomically writes result rows to a CSV laid out like pandas' DataFrame.to_csv, with a
+    leading index column, without importing pandas.
+    """
+    tmp_path = f"{csv_path}.tmp"
+    with open(tmp_path, "w") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["", *columns])
+        writer.writerows([i, *row] for i, row in enumerate(rows))
+    replace(tmp_path, csv_path)
+
+
+class BatchEngine:
+    """
+    Long-lived counting and writer pools, reused across run() calls so repeated batches skip
+    process start-up and re-importing OpenCV and friends in every worker.
+    Each batch registers its settings in a Manager dict that workers read once per batch.
+    With worker_type "thread", counting runs on threads of this process instead (see
+    WORKER_TYPES), which share one plain dict of settings; the writers are always processes.
+    """
+
+    def __init__(self, processes=None, writer_processes=WRITER_PROCESSES, worker_type="process"):
+        self.manager = Manager()
+        # Threads read the settings from this process directly rather than a copy per worker
+        self.batches = dict() if worker_type == "thread" else self.manager.dict()
+        # Cancel event of the running batch; each batch gets its own so stale tasks stay cancelled
+        self.cancel_event = None
+        self.processes = processes or cpu_count()
+        self.pool = counting_pool(worker_type, self.processes, self.batches)
+        self.writer_processes = writer_processes
+        self.writer_pool = Pool(writer_processes, initializer=ignore_interrupts)
+
+    def cancel(self):
+        """
+        Stops the running batch; images already counted stay in the partial results and cache.
+        """
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+
+    def close(self):
+        self.cancel()
+        self.pool.terminate()
+        self.writer_pool.terminate()
+        self.manager.shutdown()
+
+
+def counting_pool(worker_type, processes, batches):
+    """
+    Starts the pool of counting workers for worker_type, one of WORKER_TYPES.
+    """
+    if worker_type == "thread":
+        return ThreadPool(processes, initializer=init_worker, initargs=(batches, False))
+    if worker_type != "process":
+        raise ValueError(f"Unknown worker type {worker_type}; expected one of {WORKER_TYPES}")
+    return Pool(processes, initializer=init_worker, initargs=(batches,))
+
+
+def init_worker(batches, ignore_signals=True):
+    """
+    Pool initializer: receives the mapping of batch ids to settings once per worker, so each
+    counting task only has to carry its batch id and filename. Thread workers leave signal
+    handling alone, which only the main thread may change.
+    """
+    if ignore_signals:
+        ignore_interrupts()
+    worker_state.batches = batches
+
+
+def ignore_interrupts():
+    """
+    Pool initializer: leaves Ctrl+C to the main process, which stops the pools itself.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def batch_settings(batch_id):
+    """
+    Returns the settings of a batch, fetching them only on the first task of each batch.
+    None is returned for a batch that has already finished or been cancelled.
+    """
+    if getattr(worker_state, "batch_id", None) != batch_id:
+        worker_state.settings = worker_state.batches.get(batch_id)
+        worker_state.batch_id = batch_id
+    return worker_state.settings
+
+
+def process_image_chunk(tasks):
+    """
+    Counts a chunk of images in one task, returning their results in order.
+    """
+    return [process_image_worker(task) for task in tasks]
+
+
+def process_image_worker(task):
+    """
+    Counts one image. When artifacts are being saved, the filename is handed to the writer
+    stage through artifact_queue so counting never waits on image encoding or plotting.
+    """
+    batch_id, filename = task
+    settings = batch_settings(batch_id)
+    if settings is None:
+        return None
+    path_to_img_dir = settings["path_to_img_dir"]
+    hsv_ranges = settings["hsv_ranges"]
+    progress_queue = settings["progress_queue"]
+    tile_rows = settings["tile_rows"]
+    artifact_queue = settings["artifact_queue"]
+    cancel_event = settings["cancel_event"]
+    histogram_dir = settings["histogram_dir"]
+    sample_step = settings["sample_step"]
     if "." not in filename:
         return None
+    if cancel_event is not None and cancel_event.is_set():
+        return None
 
     print(f"Processing {filename}")
-    red_pixel_area, non_tissue_area, total_area, percentage, images = get_pixel_count(
-        path_to_img_dir, filename, hsv_ranges
+    # Buffers reused by every image this worker counts; see reuse_buffer
+    if not hasattr(worker_state, "buffers"):
+        worker_state.buffers = dict()
+    buffers = worker_state.buffers
+    trace = dict() if settings["trace"] else None
+    worker_start = start_timer(trace)
+    if histogram_dir is not None:
+        # Counting from the histogram gives the same numbers in the same single decode
+        codes, counts = compute_hsv_histogram(
+            path.join(path_to_img_dir, filename), tile_rows or TILE_ROWS, trace
+        )
+        start = start_timer(trace)
+        sidecar = histogram_path(histogram_dir, filename)
+        makedirs(path.dirname(sidecar), exist_ok=True)
+        np.savez_compressed(sidecar, codes=codes, counts=counts)
+        start = add_stage_time(trace, "save_histogram_s", start)
+        red_pixel_area, non_tissue_area, total_area, percentage = count_histogram(
+            codes, counts, hsv_ranges
+        )
+        add_stage_time(trace, "count_s", start)
+        if trace is not None:
+            trace["bytes_written"] = stat(sidecar).st_size
+    elif sample_step:
+        (
+            red_pixel_area,
+            non_tissue_area,
+            total_area,
+            percentage,
+            percentage_error,
+        ) = get_pixel_count_sampled(path_to_img_dir, filename, hsv_ranges, sample_step, trace)
+    elif tile_rows:
+        red_pixel_area, non_tissue_area, total_area, percentage, _ = get_pixel_count_tiled(
+            path_to_img_dir, filename, hsv_ranges, tile_rows, trace, buffers
+        )
+    else:
+        red_pixel_area, non_tissue_area, total_area, percentage, _ = get_pixel_count(
+            path_to_img_dir, filename, hsv_ranges, return_images=False, trace=trace, buffers=buffers
+        )
+
+    if trace is not None:
+        trace["bytes_read"] = stat(path.join(path_to_img_dir, filename)).st_size
+        add_stage_time(trace, "count_total_s", worker_start)
+
+    if artifact_queue is not None:
+        # Progress is reported by the writer once the artifacts exist
+        artifact_queue.put(filename)
+    elif progress_queue:
+        progress_queue.put(1)
+
+    result = [filename, red_pixel_area, non_tissue_area, total_area, percentage]
+    if sample_step:
+        result.append(percentage_error)
+    return result, trace
+
+
+def artifact_writer_worker(args):
+    """
+    Writer stage: saves review images (and optionally the summary plot) for every filename taken
+    from artifact_queue until a None sentinel arrives. Returns (filename, trace) for every image
+    it saved, where trace is None unless tracing is on.
+    """
+    (
+        path_to_img_dir,
+        hsv_ranges,
+        output_dir,
+        save_extension,
+        plot_renderer,
+        montage_width,
+        artifact_format,
+        tracing,
+        artifact_queue,
+        progress_queue,
+        cancel_event,
+    ) = args
+    saved = []
+    while True:
+        filename = artifact_queue.get()
+        if filename is None:
+            return saved
+        if cancel_event is not None and cancel_event.is_set():
+            continue
+
+        try:
+            trace = dict() if tracing else None
+            start = start_timer(trace)
+            save_artifacts(
+                path_to_img_dir,
+                filename,
+                hsv_ranges,
+                output_dir,
+                save_extension,
+                plot_renderer,
+                montage_width,
+                artifact_format,
+                trace,
+            )
+            add_stage_time(trace, "total_s", start)
+            if trace is not None:
+                # Stages shared with counting are reported separately for the writer
+                trace = {
+                    k if k in WRITER_STAGES else f"writer_{k}": v
+                    for k, v in trace.items()
+                    if k not in ["width", "height"]
+                }
+            saved.append((filename, trace))
+        except Exception as e:
+            # Keep draining the queue so counting workers never block on a dead writer
+            print(f"Could not save artifacts for {filename}: {e}")
+
+        if progress_queue:
+            progress_queue.put(1)
+
+
+def start_writer_stage(
+    artifact_args, progress_queue, writer_processes, artifact_queue_size, engine=None
+):
+    """
+    Starts writer_processes artifact writers reading from a bounded queue, on the engine's
+    writer pool if one is given.
+    artifact_args is (path_to_img_dir, hsv_ranges, output_dir, save_extension, plot_renderer,
+    montage_width, artifact_format, tracing), see save_artifacts.
+    """
+    if engine is None:
+        manager = Manager()
+        pool = Pool(writer_processes, initializer=ignore_interrupts)
+        cancel_event = None
+    else:
+        manager = engine.manager
+        pool = engine.writer_pool
+        writer_processes = engine.writer_processes
+        cancel_event = engine.cancel_event
+    artifact_queue = manager.Queue(artifact_queue_size)
+    writer_args = (*artifact_args, artifact_queue, progress_queue, cancel_event)
+    writers = [
+        pool.apply_async(artifact_writer_worker, (writer_args,))
+        for _ in range(writer_processes)
+    ]
+
+    return {
+        "manager": manager,
+        "queue": artifact_queue,
+        "pool": pool,
+        "writers": writers,
+        "owned": engine is None,
+    }
+
+
+def finish_writer_stage(writer_stage):
+    """
+    Signals the writers that counting is done, waits for the queued artifacts and returns a dict
+    of the filenames that were saved to their writer traces.
+    """
+    for _ in writer_stage["writers"]:
+        writer_stage["queue"].put(None)
+    saved = {filename: trace for writer in writer_stage["writers"] for filename, trace in writer.get()}
+    if writer_stage["owned"]:
+        writer_stage["pool"].close()
+        writer_stage["pool"].join()
+        writer_stage["manager"].shutdown()
+
+    return saved
+
+
+def abort_writer_stage(writer_stage):
+    """
+    Stops the writers after a failed batch without waiting for their artifacts.
+    """
+    if writer_stage["owned"]:
+        writer_stage["pool"].terminate()
+        writer_stage["manager"].shutdown()
+    else:
+        for _ in writer_stage["writers"]:
+            writer_stage["queue"].put(None)
+
+
+def save_artifacts(
+    path_to_img_dir,
+    filename,
+    hsv_ranges,
+    output_dir,
+    save_extension,
+    plot_renderer="matplotlib",
+    montage_width=MONTAGE_WIDTH,
+    artifact_format="images",
+    trace=None,
+):
+    """
+    Rebuilds the review artifacts for one image and saves them with its summary plot, drawn by
+    plot_renderer ("matplotlib" or "montage"); no plot is saved when plot_renderer is None.
+    artifact_format "images" saves the six review images, "masks" a single mask archive
+    (see save_mask_archive).
+    """
+    img, img_hsv, red_pixel_area, non_tissue_area, total_area, percentage, masks = count_image(
+        path_to_img_dir, filename, hsv_ranges, trace=trace
     )
+    images = None
+    if artifact_format == "images" or plot_renderer is not None:
+        start = start_timer(trace)
+        images = build_images(img, img_hsv, masks)
+        add_stage_time(trace, "images_s", start)
 
-    if save_files:
-        plots_dir = f"{output_dir}/plots"
-        path_to_new_folder = generate_image_subdirectory_path(filename, output_dir)
-        makedirs(path_to_new_folder, exist_ok=True)
+    start = start_timer(trace)
+    path_to_new_folder = generate_image_subdirectory_path(filename, output_dir)
+    makedirs(path_to_new_folder, exist_ok=True)
+    if artifact_format == "masks":
+        save_mask_archive(
+            masks, path_to_new_folder, filename, compile_hsv_ranges(hsv_ranges).digest()
+        )
+    else:
         save_images(images, path_to_new_folder, filename, save_extension)
+    start = add_stage_time(trace, "save_images_s", start)
+    if plot_renderer is not None:
+        # Images found in subfolders keep their relative path under plots/
+        makedirs(path.dirname(path.join(output_dir, "plots", filename)), exist_ok=True)
+    if plot_renderer == "montage":
+        generate_montage(
+            images,
+            filename,
+            total_area,
+            red_pixel_area,
+            non_tissue_area,
+            percentage,
+            f"{output_dir}/plots",
+            save_extension,
+            montage_width,
+        )
+    elif plot_renderer == "matplotlib":
         generate_plot(
             images,
             filename,
@@ -192,15 +1628,18 @@ def process_image_worker(args):
             red_pixel_area,
             non_tissue_area,
             percentage,
-            plots_dir,
-            save_files,
-            save_extension
+            f"{output_dir}/plots",
+            True,
+            save_extension,
         )
+    add_stage_time(trace, "plot_s", start)
 
-    if progress_queue:
-        progress_queue.put(1)
-
-    return [filename, red_pixel_area, non_tissue_area, total_area, percentage]
+    if trace is not None:
+        written = [path.join(path_to_new_folder, f) for f in listdir(path_to_new_folder)]
+        plot_path = path.join(output_dir, "plots", f"{filename}_plot{save_extension}")
+        if plot_renderer is not None and path.exists(plot_path):
+            written.append(plot_path)
+        trace["bytes_written"] = sum(stat(f).st_size for f in written)
 
 
 def run(
@@ -210,46 +1649,397 @@ def run(
     output_dir=None,
     hsv_ranges_override=None,
     progress_queue=None,
-    save_extension=".tif"
+    save_extension=".tif",
+    tile_rows=None,
+    use_cache=True,
+    hash_contents=False,
+    save_plots=True,
+    plot_renderer="matplotlib",
+    montage_width=MONTAGE_WIDTH,
+    writer_processes=WRITER_PROCESSES,
+    artifact_queue_size=ARTIFACT_QUEUE_SIZE,
+    engine=None,
+    save_histograms=False,
+    processes=None,
+    trace=False,
+    sample_step=None,
+    artifact_format="images",
+    recursive=False,
+    include=None,
+    exclude=None,
+    manifest_path=None,
+    memory_budget=None,
+    shard=None,
+    worker_type="process",
 ):
     """
     Runs the procedure to generate pixel counts for the given images in parallel.
+    When tile_rows is set, images are counted in strips of that many rows to bound per-worker
+    memory.
+    Counting and saving review artifacts are separate stages: counting workers pass finished
+    filenames through a queue of at most artifact_queue_size entries to writer_processes writer
+    processes, which rebuild and save the review images (and plots, unless save_plots is off),
+    so results are not held up by image encoding. plot_renderer picks the matplotlib figure or
+    the faster OpenCV montage (montage_width pixels wide) for the summary plots.
+    Results are appended to PSR_results.partial.csv as workers finish, in any order, and
+    PSR_results.csv is written atomically, sorted by filename, as soon as counting completes,
+    without waiting for the writers.
+    With use_cache, results are also recorded in PSR_cache.jsonl as each image finishes. Later
+    runs with the same effective ranges reuse them for unchanged files without decoding the
+    images, so interrupted batches resume where they stopped. When saving files, an image is
+    only reused if its review artifacts were saved with the same extension, plot renderer,
+    montage width and artifact format.
+    A BatchEngine can be passed to run on its long-lived pools instead of starting new ones;
+    its cancel() stops the batch early, leaving PSR_results.partial.csv in place.
+    With save_histograms, an exact HSV histogram of every image is saved under histograms/ so
+    rescore() can apply new ranges later without decoding the images again.
+    processes sets the number of counting workers (default: one per core), and worker_type
+    whether they are processes or threads sharing the compiled settings (see WORKER_TYPES);
+    an engine's own worker type is used when one is given.
+    With trace, the image size, bytes read and written and the time spent in every stage are
+    written per image to PSR_trace.csv, and a summary of where the time went is printed.
+    With sample_step, counts are estimated from a sample of the pixels (see
+    get_pixel_count_sampled) and a percent_red_error column is added to the results; review
+    images and plots are still built from the full image.
+    artifact_format "masks" saves one bit-packed mask archive per image instead of the six
+    review images; load_review_images rebuilds them from it and the original image.
+    image_format is one file extension or a list of them. With recursive, images in subfolders
+    are included too and keep their relative path as filename; include and exclude are lists
+    of globs matched against that path (see discover_images). The images found are recorded
+    with their size and mtime in PSR_manifest.csv, or in manifest_path if given. An existing
+    manifest_path is read instead of scanning the folder again, and its sizes and mtimes are
+    used to check the cache without touching the files.
+    Images are counted largest first, so big slides do not finish alone at the end of a batch.
+    With memory_budget (bytes), the memory of each image is estimated from its dimensions and
+    large images only run together while their estimates fit in the budget (see schedule_tasks).
+    With shard (index, count), only the images in that shard are counted (see in_shard) and the
+    results, cache and trace files are named after the shard, so several nodes can share one
+    output folder; merge_shards combines their results. The manifest lists every image.
     """
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Shard index {shard[0]} is not between 0 and {shard[1] - 1}")
+    if sample_step is not None and sample_step < 3:
+        # At 1 the four offset grids sample the same pixels; at 2 they cover every pixel, an
+        # exact count with no speedup and a meaningless error estimate
+        raise ValueError(f"sample_step must be at least 3, got {sample_step}")
+    if sample_step and save_histograms:
+        raise ValueError("Histograms need exact counts and cannot be saved with sample_step")
+
+    batch_start = time.perf_counter()
+    results_dir = output_dir if output_dir else path_to_img_dir
+    if recursive and is_within(results_dir, path_to_img_dir):
+        # Saved review images would be discovered as inputs by the next run
+        raise ValueError("Recursive runs need an output folder outside the images folder")
+    makedirs(results_dir, exist_ok=True)
+
     # Use override if provided
     hsv_ranges = hsv_ranges_override if hsv_ranges_override is not None else HSV_RANGES
 
     # Create plots directory
-    if save_files and output_dir:
-        plots_dir = path.join(output_dir, "plots")
+    if save_files and save_plots:
+        plots_dir = path.join(results_dir, "plots")
         makedirs(plots_dir, exist_ok=True)
 
-    # Grab files from specified directory
-    onlyfiles = [f for f in listdir(path_to_img_dir) if f.endswith(image_format)]
+    # Compile the ranges once so every worker reuses the same lookup tables
+    hsv_ranges = compile_hsv_ranges(hsv_ranges)
+
+    # Grab files from the manifest of an earlier scan, or scan the images folder
+    if manifest_path is not None and path.exists(manifest_path):
+        images = load_manifest(manifest_path, image_format, include, exclude)
+    else:
+        images = discover_images(path_to_img_dir, image_format, recursive, include, exclude)
+        write_manifest(manifest_path or path.join(results_dir, MANIFEST_CSV), images)
+    if shard is not None:
+        images = [image for image in images if in_shard(image[0], shard)]
+    onlyfiles = [filename for filename, _, _ in images]
+
+    # Reuse cached results for files and settings that have not changed
+    cache_path = path.join(results_dir, shard_filename(RESULTS_CACHE, shard))
+    cache = load_results_cache(cache_path) if use_cache else dict()
+    settings_digest = hsv_ranges.digest()
+    if sample_step:
+        # Approximate results must never be reused by an exact run, or vice versa
+        settings_digest += f":sample_step={sample_step}"
+    # Review artifacts are only reused when they were saved with the same options
+    artifacts_digest = (
+        f"extension={save_extension}:plots={plot_renderer if save_plots else None}:"
+        f"montage_width={montage_width}:format={artifact_format}"
+    )
+    result_columns = APPROXIMATE_RESULT_COLUMNS if sample_step else RESULT_COLUMNS
+    histogram_dir = path.join(results_dir, HISTOGRAMS_DIR) if save_histograms else None
+    entries = dict()
+    pending = []
+    for filename, size, mtime_ns in images:
+        identity = (
+            file_identity(path.join(path_to_img_dir, filename), hash_contents)
+            if hash_contents
+            else {"size": size, "mtime_ns": mtime_ns}
+        )
+        entry = cache.get(filename)
+        if (
+            entry is not None
+            and entry["identity"] == identity
+            and entry["settings"] == settings_digest
+            and (entry["saved"] == artifacts_digest or not save_files)
+            and (
+                histogram_dir is None
+                or path.exists(histogram_path(histogram_dir, filename))
+            )
+        ):
+            entries[filename] = entry
+            if progress_queue:
+                progress_queue.put(1)
+        else:
+            pending.append((filename, identity))
 
-    pool_args = [
-        (path_to_img_dir, filename, hsv_ranges, output_dir, save_files, save_extension, progress_queue)
-        for filename in onlyfiles
+    # Each batch gets its own cancel event, so tasks left over from a cancelled batch stay skipped
+    cancel_event = None
+    if engine is not None:
+        cancel_event = engine.cancel_event = engine.manager.Event()
+
+    # Writer stage for review images and plots, fed by the counting workers
+    writer_stage = None
+    artifact_queue = None
+    if save_files and pending:
+        writer_stage = start_writer_stage(
+            (
+                path_to_img_dir,
+                hsv_ranges,
+                results_dir,
+                save_extension,
+                plot_renderer if save_plots else None,
+                montage_width,
+                artifact_format,
+                trace,
+            ),
+            progress_queue,
+            writer_processes,
+            artifact_queue_size,
+            engine,
+        )
+        artifact_queue = writer_stage["queue"]
+
+    # Settings every counting worker reads once; tasks only carry the batch id and a filename
+    batch_id = uuid.uuid4().hex
+    batch = {
+        "path_to_img_dir": path_to_img_dir,
+        "hsv_ranges": hsv_ranges,
+        "progress_queue": progress_queue,
+        "tile_rows": tile_rows,
+        "artifact_queue": artifact_queue,
+        "cancel_event": cancel_event,
+        "histogram_dir": histogram_dir,
+        "trace": trace,
+        "sample_step": sample_step,
+    }
+    if engine is None:
+        pool = counting_pool(worker_type, processes or cpu_count(), {batch_id: batch})
+    else:
+        engine.batches[batch_id] = batch
+        pool = engine.pool
+
+    # Largest images first, sized by their estimated memory: from the dimensions in the file
+    # header, which reflect the pixel count whatever the compression
+    workers = engine.processes if engine is not None else processes or cpu_count()
+    sizes = {filename: size for filename, size, _ in images}
+    tasks = [
+        (
+            filename,
+            estimate_image_memory(
+                path.join(path_to_img_dir, filename),
+                sizes[filename],
+                tile_rows,
+                histogram_dir is not None,
+                sample_step,
+            ),
+        )
+        for filename, _ in pending
     ]
+    tasks.sort(key=lambda task: task[1], reverse=True)
 
-    with Pool() as pool:
-        results = pool.map(process_image_worker, pool_args)
+    # Stream results to the partial CSV as workers finish, in completion order
+    identities = dict(pending)
+    traces = dict()
+    partial_path = path.join(results_dir, shard_filename(RESULTS_PARTIAL_CSV, shard))
+    cancelled = False
+    try:
+        with open(partial_path, "w", newline="") as partial_file, (
+            open(cache_path, "a") if use_cache else contextlib.nullcontext()
+        ) as cache_file:
+            writer = csv.writer(partial_file)
+            writer.writerow(result_columns)
+            writer.writerows(entries[f]["result"] for f in onlyfiles if f in entries)
+            partial_file.flush()
 
-    # create Data frame for pixel stats results
-    df = pd.DataFrame(
-        [r for r in results if r is not None],
-        columns=[
-            "filename",
-            "red_pixel_count",
-            "non_tissue_pixel_count",
-            "total_pixel_count",
-            "percent_red",
-        ],
-    )
+            for result in schedule_tasks(pool, batch_id, tasks, workers, memory_budget):
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    break
+                if result is None:
+                    continue
+                result, image_trace = result
+                filename = result[0]
+                if image_trace is not None:
+                    traces[filename] = image_trace
+                entries[filename] = entry = {
+                    "identity": identities[filename],
+                    "settings": settings_digest,
+                    "saved": None,
+                    "result": result,
+                }
+                if use_cache:
+                    append_results_cache(cache_file, entry)
+                writer.writerow(result)
+                partial_file.flush()
+    except BaseException:
+        if writer_stage is not None:
+            abort_writer_stage(writer_stage)
+        raise
+    finally:
+        if engine is None:
+            pool.terminate()
+        else:
+            del engine.batches[batch_id]
+
+    if not cancelled:
+        # Counting is done, so the results are complete before the writers finish: write the
+        # final CSV atomically, then drop the partial one it supersedes
+        write_results_csv(
+            path.join(results_dir, shard_filename(RESULTS_CSV, shard)),
+            [entries[f]["result"] for f in sorted(entries)],
+            result_columns,
+        )
+        remove(partial_path)
+
+    # Let the writers finish the queued artifacts, then record which images they saved
+    if writer_stage is not None:
+        for filename, writer_trace in finish_writer_stage(writer_stage).items():
+            # A cancelled batch may save images whose counts were never collected
+            if filename in entries:
+                entries[filename]["saved"] = artifacts_digest
+            if filename in traces and writer_trace is not None:
+                bytes_written = traces[filename].get("bytes_written", 0)
+                traces[filename].update(writer_trace)
+                traces[filename]["bytes_written"] += bytes_written
+
+    # Compact the cache to one entry per image in this folder
+    if use_cache:
+        write_results_cache(cache_path, [entries[f] for f in onlyfiles if f in entries])
 
-    df.to_csv(f"{(output_dir if output_dir else path_to_img_dir)}/PSR_results.csv")
+    if trace:
+        write_trace(
+            path.join(results_dir, shard_filename(TRACE_CSV, shard)),
+            traces,
+            time.perf_counter() - batch_start,
+        )
+
+    if cancelled:
+        # Keep the partial CSV; the cache lets the next run resume from here
+        print("Cancelled")
+        return
     print("Done!")
 
 
+def watch(
+    path_to_img_dir,
+    image_format,
+    output_dir=None,
+    poll_interval=WATCH_POLL_SECONDS,
+    settle_seconds=WATCH_SETTLE_SECONDS,
+    recursive=False,
+    include=None,
+    exclude=None,
+    processes=None,
+    writer_processes=WRITER_PROCESSES,
+    worker_type="process",
+    **run_options,
+):
+    """
+    Watches path_to_img_dir and counts new or changed images as they arrive, until interrupted.
+    Worker pools and compiled ranges stay warm for the whole watch, so an image is counted and
+    its results written within seconds of being complete.
+    The folder is scanned every poll_interval seconds. A file counts as fully written once its
+    size and mtime are unchanged on a later scan and have stayed so for settle_seconds. Its
+    mtime alone is not trusted, since copies that keep the source mtime look old while writing.
+    Each group of arrivals is passed to run() along with a manifest of every image counted so
+    far. Results are therefore appended to PSR_cache.jsonl as they finish, and
+    PSR_results.csv is rewritten to cover the whole folder. Other keyword arguments are
+    passed on to run().
+    An image that cannot be processed is reported and skipped until it changes.
+    """
+    if run_options.get("use_cache") is False:
+        raise ValueError("Watching relies on the results cache to skip counted images")
+
+    results_dir = output_dir if output_dir else path_to_img_dir
+    makedirs(results_dir, exist_ok=True)
+    manifest_path = path.join(results_dir, MANIFEST_CSV)
+    hsv_ranges = run_options.pop("hsv_ranges_override", None)
+    hsv_ranges = compile_hsv_ranges(hsv_ranges if hsv_ranges is not None else HSV_RANGES)
+    engine = BatchEngine(processes, writer_processes, worker_type)
+
+    def count(images):
+        write_manifest(manifest_path, images)
+        run(
+            path_to_img_dir,
+            image_format,
+            output_dir=output_dir,
+            hsv_ranges_override=hsv_ranges,
+            engine=engine,
+            recursive=recursive,
+            include=include,
+            exclude=exclude,
+            manifest_path=manifest_path,
+            **run_options,
+        )
+
+    # Per filename: its (size, mtime_ns) when last scanned, and the time and scan number since
+    # which it has been unchanged
+    observed = dict()
+    # Per filename: the (filename, size, mtime_ns) that was counted, or that failed
+    counted = dict()
+    failed = dict()
+    print(f"Watching {path_to_img_dir} for new images (Ctrl+C to stop)")
+    try:
+        scan = 0
+        while True:
+            scan += 1
+            now = time.time()
+            done = []
+            arrived = []
+            for image in discover_images(path_to_img_dir, image_format, recursive, include, exclude):
+                filename, size, mtime_ns = image
+                if filename not in observed or observed[filename][0] != (size, mtime_ns):
+                    observed[filename] = ((size, mtime_ns), now, scan)
+                _, since, first_scan = observed[filename]
+                settled = first_scan < scan and now - since >= settle_seconds
+                if counted.get(filename) == image:
+                    done.append(image)
+                elif size > 0 and settled and failed.get(filename) != image:
+                    arrived.append(image)
+
+            if arrived:
+                try:
+                    count(done + arrived)
+                    counted.update((image[0], image) for image in arrived)
+                except Exception as e:
+                    # Find the images that fail by counting the new ones one at a time
+                    print(f"Batch failed ({e}), retrying new images one by one")
+                    for image in arrived:
+                        try:
+                            count(done + [image])
+                            counted[image[0]] = image
+                            done.append(image)
+                        except Exception as e:
+                            print(f"Could not process {image[0]}: {e}")
+                            failed[image[0]] = image
+
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        engine.close()
+
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument(
@@ -258,7 +2048,217 @@ if __name__ == "__main__":
         help="path to the images folder, e.g., ./python convert.py -p './images'",
         required=True,
     )
-    ap.add_argument("-x", "--ext", help="image file extension", default=".tif")
+    ap.add_argument(
+        "-x", "--ext", nargs="+", help="image file extensions", default=[".tif"]
+    )
+    ap.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="include images in subfolders (needs an --output folder outside --path)",
+    )
+    ap.add_argument(
+        "--include",
+        nargs="+",
+        help="only process images whose path relative to --path matches one of these globs",
+    )
+    ap.add_argument(
+        "--exclude",
+        nargs="+",
+        help="skip images and subfolders whose relative path matches one of these globs",
+    )
+    ap.add_argument(
+        "--manifest",
+        help="reuse this list of images, sizes and mtimes instead of scanning --path; it is "
+        "written by the scan if it does not exist yet",
+    )
+    ap.add_argument(
+        "-o",
+        "--output",
+        help="folder for results, review images and plots (default: the images folder)",
+    )
+    ap.add_argument(
+        "-s",
+        "--settings",
+        help="settings JSON saved by the GUI to take the HSV ranges from",
+    )
+    ap.add_argument(
+        "--histograms",
+        action="store_true",
+        help="save an HSV histogram of every image so new settings can be re-scored quickly",
+    )
+    ap.add_argument(
+        "--rescore",
+        action="store_true",
+        help="re-score the histograms in the results folder --path with --settings instead of "
+        "processing images",
+    )
+    ap.add_argument(
+        "--shard-index",
+        type=int,
+        help="count only this shard (0 to --shard-count - 1) of the images, for running one "
+        "batch on several machines sharing the output folder",
+    )
+    ap.add_argument("--shard-count", type=int, help="number of shards the images are split into")
+    ap.add_argument(
+        "--merge",
+        action="store_true",
+        help="combine the shard results in the results folder --path into PSR_results.csv",
+    )
+    ap.add_argument(
+        "--no-save",
+        action="store_true",
+        help="only write PSR_results.csv, skipping review images and plots",
+    )
+    ap.add_argument(
+        "--no-plots",
+        action="store_true",
+        help="save review images but skip the summary plots",
+    )
+    ap.add_argument(
+        "--plot-renderer",
+        choices=PLOT_RENDERERS,
+        default="matplotlib",
+        help="draw summary plots with matplotlib or as a faster OpenCV montage",
+    )
+    ap.add_argument(
+        "--artifacts",
+        choices=ARTIFACT_FORMATS,
+        default="images",
+        help="save the six review images, or one compact archive of the two masks per image",
+    )
+    ap.add_argument(
+        "--montage-width",
+        type=int,
+        default=MONTAGE_WIDTH,
+        help="width in pixels of montage summary plots",
+    )
+    ap.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        help="number of counting worker processes (default: one per core)",
+    )
+    ap.add_argument(
+        "--worker-type",
+        choices=WORKER_TYPES,
+        default="process",
+        help="count images in worker processes, or in threads sharing the settings and memory",
+    )
+    ap.add_argument(
+        "--memory-budget",
+        type=float,
+        help="memory in MB that concurrently counted images may use; large images wait for room",
+    )
+    ap.add_argument(
+        "--writers",
+        type=int,
+        default=WRITER_PROCESSES,
+        help="number of processes saving review images and plots",
+    )
+    ap.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="reprocess every image instead of reusing results cached by earlier runs",
+    )
+    ap.add_argument(
+        "--hash-contents",
+        action="store_true",
+        help="identify cached images by a hash of their contents instead of size and mtime",
+    )
+    ap.add_argument(
+        "--tile-rows",
+        type=int,
+        help="classify images in strips of this many rows to bound memory",
+    )
+    ap.add_argument(
+        "--sample-step",
+        type=int,
+        help="estimate counts from every Nth pixel of every Nth row (four offset grids) and "
+        "report percent_red_error; much faster for uncompressed TIFFs",
+    )
+    ap.add_argument(
+        "--trace",
+        action="store_true",
+        help="record per-image stage timings and sizes in PSR_trace.csv and print a summary",
+    )
+    ap.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and count new images as they are written to --path",
+    )
+    ap.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WATCH_POLL_SECONDS,
+        help="seconds between scans of the watched folder",
+    )
+    ap.add_argument(
+        "--settle",
+        type=float,
+        default=WATCH_SETTLE_SECONDS,
+        help="seconds a file must stay unchanged before it is considered fully written",
+    )
     args = vars(ap.parse_args())
+    if args["watch"] and (args["no_cache"] or args["manifest"]):
+        ap.error("--watch keeps its own cache and manifest; drop --no-cache and --manifest")
+    if (args["shard_index"] is None) != (args["shard_count"] is None) and not args["merge"]:
+        ap.error("--shard-index and --shard-count go together")
+    if args["sample_step"] is not None and args["sample_step"] < 3:
+        ap.error("--sample-step must be at least 3; use exact counting instead of 1 or 2")
+    if args["watch"] and args["shard_index"] is not None:
+        ap.error("--watch cannot be sharded")
+    hsv_ranges = load_settings(args["settings"]) if args["settings"] else None
+
+    if args["rescore"]:
+        rescore(
+            args["path"],
+            hsv_ranges if hsv_ranges is not None else HSV_RANGES,
+            path.join(args["output"], RESCORED_CSV) if args["output"] else None,
+        )
+        raise SystemExit
+
+    if args["merge"]:
+        problems = merge_shards(args["path"], args["shard_count"], args["manifest"])
+        raise SystemExit(1 if any(problems.values()) else 0)
 
-    run(args["path"], image_format=args["ext"])
+    run_options = dict(
+        output_dir=args["output"],
+        hsv_ranges_override=hsv_ranges,
+        save_histograms=args["histograms"],
+        save_files=not args["no_save"],
+        tile_rows=args["tile_rows"],
+        hash_contents=args["hash_contents"],
+        save_plots=not args["no_plots"],
+        plot_renderer=args["plot_renderer"],
+        montage_width=args["montage_width"],
+        writer_processes=args["writers"],
+        processes=args["processes"],
+        worker_type=args["worker_type"],
+        trace=args["trace"],
+        sample_step=args["sample_step"],
+        artifact_format=args["artifacts"],
+        recursive=args["recursive"],
+        include=args["include"],
+        exclude=args["exclude"],
+        memory_budget=args["memory_budget"] * 2**20 if args["memory_budget"] else None,
+    )
+    if args["watch"]:
+        watch(
+            args["path"],
+            args["ext"],
+            poll_interval=args["poll_interval"],
+            settle_seconds=args["settle"],
+            **run_options,
+        )
+    else:
+        run(
+            args["path"],
+            image_format=args["ext"],
+            use_cache=not args["no_cache"],
+            manifest_path=args["manifest"],
+            shard=(args["shard_index"], args["shard_count"])
+            if args["shard_index"] is not None
+            else None,
+            **run_options,
+        )
@@ -0,0 +1,400 @@
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import Process, Queue, cpu_count
+from os import path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import analyzer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then reported as None
+    resource = None
+
+# Colors (BGR) of the synthetic PSR-stained slides
+BACKGROUND_BGR = (232, 240, 244)
+TISSUE_BGR = (150, 190, 235)
+COLLAGEN_BGR = (50, 20, 175)
+VOID_BGR = (245, 250, 252)
+
+STAGES = [
+    "create_mask",
+    "counts",
+    "counts_tiled",
+    "histogram",
+    "images",
+    "save_images",
+    "generate_plot",
+    "generate_montage",
+]
+
+
+def generate_image(size, seed=0):
+    """
+    Deterministically generates a size x size BGR image resembling a PSR-stained slide: pale
+    background, tissue islands with red collagen fibers and white voids, plus sensor noise.
+    The structure is drawn at 1/8 resolution and upsampled, so whole-slide sizes stay cheap.
+    """
+    rng = np.random.default_rng(seed)
+    small = max(8, size // 8)
+
+    def field(sigma):
+        noise = rng.standard_normal((small, small)).astype(np.float32)
+        noise = cv2.GaussianBlur(noise, (0, 0), sigma)
+        return cv2.resize(noise / noise.std(), (size, size), interpolation=cv2.INTER_LINEAR)
+
+    tissue = field(small / 16) > -0.3
+    collagen = tissue & (np.abs(field(small / 64)) < 0.25)
+    voids = tissue & (field(small / 32) > 1.4)
+
+    img = np.empty((size, size, 3), dtype=np.uint8)
+    img[:] = BACKGROUND_BGR
+    img[tissue] = TISSUE_BGR
+    img[collagen] = COLLAGEN_BGR
+    img[voids] = VOID_BGR
+
+    # Repeat one noise tile rather than drawing noise for every pixel of a whole slide
+    tile = rng.integers(-12, 13, (256, 256, 3), dtype=np.int16)
+    reps = (size + 255) // 256
+    noise = np.tile(tile, (reps, reps, 1))[:size, :size]
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def generate_ranges(range_count, seed=0):
+    """
+    Deterministically generates range_count HSV ranges, split between red and white, around the
+    colors used by generate_image, with the GUI's default tolerances.
+    """
+    rng = np.random.default_rng(seed)
+    centers = {
+        "red": cv2.cvtColor(np.uint8([[COLLAGEN_BGR]]), cv2.COLOR_BGR2HSV)[0, 0].astype(int),
+        "white": cv2.cvtColor(np.uint8([[VOID_BGR]]), cv2.COLOR_BGR2HSV)[0, 0].astype(int),
+    }
+    tolerances = np.array([10, 40, 40])
+    hsv_ranges = {"red": [], "white": []}
+    for i in range(range_count):
+        mask_type = "red" if i % 2 == 0 else "white"
+        center = centers[mask_type] + rng.integers(-8, 9, 3)
+        hsv_ranges[mask_type].append(
+            {
+                "lower": np.maximum(0, center - tolerances),
+                "upper": np.minimum(255, center + tolerances),
+            }
+        )
+
+    return hsv_ranges
+
+
+def reference_counts(img, hsv_ranges):
+    """
+    The original counting procedure (summed inRange masks, masked HSV image, gray conversion),
+    kept here to check that optimized paths report exactly the same numbers.
+    """
+    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    counts = []
+    for color in ["red", "white"]:
+        mask = np.zeros(img_hsv.shape[:2], dtype=np.uint8)
+        for color_range in hsv_ranges[color]:
+            mask += cv2.inRange(img_hsv, color_range["lower"], color_range["upper"])
+        masked = cv2.bitwise_and(img_hsv, img_hsv, mask=mask)
+        counts.append(cv2.countNonZero(cv2.cvtColor(masked, cv2.COLOR_BGR2GRAY)))
+
+    red_pixel_area, non_tissue_area = counts
+    total_area = img.shape[0] * img.shape[1]
+    percentage = red_pixel_area / (total_area - non_tissue_area)
+    return (red_pixel_area, non_tissue_area, total_area, percentage)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process and of its finished children, in MB.
+    """
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return {"self": own / 2**20, "children": children / 2**20}
+
+
+def latency_summary(latencies):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mean": float(latencies_ms.mean()),
+        "p50": float(np.percentile(latencies_ms, 50)),
+        "p90": float(np.percentile(latencies_ms, 90)),
+        "p99": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def bench_stage(case, workdir):
+    """
+    Times one analyzer stage on a single image, repeat times.
+    """
+    img = generate_image(case["size"], case["seed"])
+    raw_ranges = generate_ranges(case["ranges"], case["seed"])
+    hsv_ranges = analyzer.compile_hsv_ranges(raw_ranges)
+    image_path = path.join(workdir, "image.png")
+    cv2.imwrite(image_path, img)
+    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    expected = reference_counts(img, raw_ranges)
+
+    red, non_tissue, total, percentage, images = analyzer.get_pixel_count(
+        workdir, "image.png", hsv_ranges
+    )
+    stage = case["stage"]
+    calls = {
+        "create_mask": lambda: hsv_ranges.masks(img_hsv),
+        "counts": lambda: analyzer.get_pixel_count(
+            workdir, "image.png", hsv_ranges, return_images=False
+        ),
+        "counts_tiled": lambda: analyzer.get_pixel_count_tiled(
+            workdir, "image.png", hsv_ranges, case["tile_rows"]
+        ),
+        "histogram": lambda: analyzer.compute_hsv_histogram(image_path, case["tile_rows"]),
+        "images": lambda: analyzer.get_pixel_count(workdir, "image.png", hsv_ranges),
+        "save_images": lambda: analyzer.save_images(images, workdir, "image.png", case["format"]),
+        "generate_plot": lambda: analyzer.generate_plot(
+            images, "image.png", total, red, non_tissue, percentage, workdir, True, case["format"]
+        ),
+        "generate_montage": lambda: analyzer.generate_montage(
+            images, "image.png", total, red, non_tissue, percentage, workdir, case["format"]
+        ),
+    }
+
+    latencies = []
+    for _ in range(case["repeat"]):
+        start = time.perf_counter()
+        result = calls[stage]()
+        latencies.append(time.perf_counter() - start)
+
+    if stage in ["counts", "counts_tiled", "images"]:
+        counts = tuple(result[:4])
+    elif stage == "histogram":
+        counts = analyzer.count_histogram(*result, hsv_ranges)
+    else:
+        counts = (red, non_tissue, total, percentage)
+
+    megapixels = case["size"] ** 2 / 1e6
+    return {
+        "latency_ms": latency_summary(latencies),
+        "throughput": {"megapixels_per_s": megapixels * len(latencies) / sum(latencies)},
+        "counts_match": counts == expected,
+    }
+
+
+def bench_run(case, workdir):
+    """
+    Times a whole analyzer.run() batch over case["images"] generated images.
+    """
+    hsv_ranges = generate_ranges(case["ranges"], case["seed"])
+    input_dir = path.join(workdir, "input")
+    output_dir = path.join(workdir, "output")
+    analyzer.makedirs(input_dir)
+    expected = dict()
+    for i in range(case["images"]):
+        filename = f"slide_{i:04d}{case['input_format']}"
+        cv2.imwrite(path.join(input_dir, filename), generate_image(case["size"], case["seed"] + i))
+        # Compare against the decoded file, since JPEG encoding changes the pixels
+        img = cv2.imread(path.join(input_dir, filename))
+        expected[filename] = reference_counts(img, hsv_ranges)
+
+    start = time.perf_counter()
+    analyzer.run(
+        input_dir,
+        case["input_format"],
+        save_files=case["save_files"],
+        output_dir=output_dir,
+        hsv_ranges_override=hsv_ranges,
+        save_extension=case["format"],
+        use_cache=False,
+        processes=case["workers"],
+        worker_type=case["worker_type"],
+    )
+    elapsed = time.perf_counter() - start
+
+    df = pd.read_csv(path.join(output_dir, analyzer.RESULTS_CSV))
+    counts = {
+        row.filename: (row.red_pixel_count, row.non_tissue_pixel_count, row.total_pixel_count)
+        for row in df.itertuples()
+    }
+    # Percentages only survive the CSV round trip approximately
+    percentages_match = all(
+        np.isclose(row.percent_red, expected[row.filename][3]) for row in df.itertuples()
+    )
+    return {
+        "latency_ms": {"batch": elapsed * 1000},
+        "throughput": {
+            "images_per_s": case["images"] / elapsed,
+            "megapixels_per_s": case["images"] * case["size"] ** 2 / 1e6 / elapsed,
+        },
+        "counts_match": percentages_match
+        and counts == {filename: values[:3] for filename, values in expected.items()},
+    }
+
+
+def case_worker(case, results):
+    """
+    Runs one case in a fresh process so its peak memory is measured in isolation.
+    """
+    workdir = tempfile.mkdtemp(prefix="psr_bench_")
+    try:
+        bench = bench_run if case["stage"] == "run" else bench_stage
+        result = bench(case, workdir)
+        result["peak_rss_mb"] = peak_rss_mb()
+        results.put(result)
+    except Exception as e:
+        results.put({"error": repr(e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_case(case):
+    results = Queue()
+    process = Process(target=case_worker, args=(case, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return {**case, **result}
+
+
+def build_cases(args):
+    common = {
+        "seed": args["seed"],
+        "format": args["format"],
+        "tile_rows": args["tile_rows"],
+    }
+    cases = []
+    for size in args["sizes"]:
+        for range_count in args["range_counts"]:
+            for stage in args["stages"]:
+                cases.append(
+                    {**common, "stage": stage, "size": size, "ranges": range_count, "repeat": args["repeat"]}
+                )
+    for size in args["run_sizes"]:
+        for workers in args["workers"]:
+            for worker_type in args["worker_types"]:
+                for save_files in [False, True]:
+                    cases.append(
+                        {
+                            **common,
+                            "stage": "run",
+                            "size": size,
+                            "ranges": args["range_counts"][0],
+                            "workers": workers,
+                            "worker_type": worker_type,
+                            "save_files": save_files,
+                            "images": args["images"],
+                            "input_format": args["input_format"],
+                        }
+                    )
+    return cases
+
+
+def case_key(case):
+    # Batches benchmarked before worker types could be chosen ran on processes
+    defaults = {"worker_type": "process"} if case["stage"] == "run" else {}
+    return tuple(
+        (k, case.get(k, defaults.get(k)))
+        for k in ["stage", "size", "ranges", "workers", "worker_type", "save_files", "images"]
+    )
+
+
+def compare(results, baseline_path):
+    """
+    Prints the speed of every case relative to the same case in an earlier benchmark JSON.
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(c): c for c in json.load(f)["cases"]}
+
+    for case in results:
+        old = baseline.get(case_key(case))
+        if old is None or "throughput" not in old or "throughput" not in case:
+            continue
+        ratio = case["throughput"]["megapixels_per_s"] / old["throughput"]["megapixels_per_s"]
+        print(f"{dict(case_key(case))}: {ratio:.2f}x")
+
+
+def print_result(case):
+    if "error" in case:
+        print(f"{case['stage']:>16} size={case['size']}: ERROR {case['error']}")
+        return
+    if case["stage"] == "run":
+        extra = (
+            f" workers={case['workers']} worker_type={case['worker_type']}"
+            f" save_files={case['save_files']}"
+        )
+        latency = f"{case['latency_ms']['batch']:.0f} ms/batch"
+    else:
+        extra = ""
+        latency = f"p50 {case['latency_ms']['p50']:.1f} ms, p99 {case['latency_ms']['p99']:.1f} ms"
+    print(
+        f"{case['stage']:>16} size={case['size']} ranges={case['ranges']}{extra}: "
+        f"{case['throughput']['megapixels_per_s']:.1f} MP/s, {latency}, "
+        f"counts match: {case['counts_match']}"
+    )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the analyzer stages on synthetic PSR images")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[512, 2048, 8192])
+    ap.add_argument("--range-counts", type=int, nargs="+", default=[2, 10, 20])
+    ap.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    ap.add_argument("--repeat", type=int, default=5, help="timed calls per stage case")
+    ap.add_argument("--run-sizes", type=int, nargs="+", default=[1024], help="image sizes for whole-batch cases")
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, cpu_count()])
+    ap.add_argument(
+        "--worker-types",
+        nargs="+",
+        choices=analyzer.WORKER_TYPES,
+        default=analyzer.WORKER_TYPES,
+        help="counting worker types to compare in whole-batch cases",
+    )
+    ap.add_argument("--images", type=int, default=16, help="images per whole-batch case")
+    ap.add_argument("--input-format", default=".jpg", help="format the batch images are stored in")
+    ap.add_argument("--format", default=".png", help="format review images and plots are saved in")
+    ap.add_argument("--tile-rows", type=int, default=analyzer.TILE_ROWS)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("-o", "--output", default="benchmark_results.json")
+    ap.add_argument("--compare", help="earlier benchmark JSON to compare against")
+    args = vars(ap.parse_args())
+
+    results = []
+    for case in build_cases(args):
+        result = run_case(case)
+        print_result(result)
+        results.append(result)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpu_count": cpu_count(),
+            "args": args,
+        },
+        "cases": results,
+    }
+    with open(args["output"], "w") as f:
+        json.dump(report, f, indent=4)
+
+    if args["compare"]:
+        compare(results, args["compare"])
+
+    if not all(case.get("counts_match") for case in results):
+        print("Counts differ from the reference implementation!")
+        sys.exit(1)
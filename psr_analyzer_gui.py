@@ -1,32 +1,177 @@
-from analyzer import RED_MASK, RED_MASK_COUNT, WHITE_MASK, WHITE_MASK_COUNT, ORIGINAL, HSV, get_pixel_count, generate_plot
+from analyzer import RED_MASK, RED_MASK_COUNT, WHITE_MASK, WHITE_MASK_COUNT, ORIGINAL, HSV, count_hsv_pixels, build_images, generate_plot, PLOT_RENDERERS, ARTIFACT_FORMATS, IMAGE_FORMATS, MANIFEST_CSV, discover_images, write_manifest, is_within
 import cv2
 import numpy as np
 import os
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from analyzer import run as run_analyzer
-import customtkinter as ctk
-import matplotlib
+from analyzer import run as run_analyzer, BatchEngine
 import json
-from tkinter import filedialog, messagebox
 import threading
 import queue
-import os
-from multiprocessing import Manager
-matplotlib.use('TkAgg')
-
-
-def count_pixels_and_plot(path, fig, HSV_RANGES, img, save_files=False):
-    red_pixel_area, non_tissue_area, total_area, percentage, images = get_pixel_count(
-        ".", path, HSV_RANGES, img, save_files=False)
-    draw_plot(fig, path, red_pixel_area, non_tissue_area,
-              total_area, percentage, images)
+# matplotlib and the Tk toolkits are imported in setup_window, so batch workers spawned from
+# this script (which re-import it) only load OpenCV and NumPy
+
+# Longest side of the downsampled copy the six panels are drawn from
+PREVIEW_MAX_SIDE = 1024
+# Milliseconds mask edits are collected before the preview is recomputed, and between checks
+# for a finished preview
+PREVIEW_DEBOUNCE_MS = 150
+PREVIEW_POLL_MS = 50
+
+
+def build_preview(img):
+    """
+    Halves the image with cv2.pyrDown until its longest side fits within PREVIEW_MAX_SIDE.
+    """
+    preview = img
+    while max(preview.shape[:2]) > PREVIEW_MAX_SIDE:
+        preview = cv2.pyrDown(preview)
+    return preview
+
+
+def count_preview(HSV_RANGES, img_hsv, preview, preview_hsv, masks=None):
+    """
+    Counts pixels on the full-resolution HSV image and builds the panels from the preview.
+    Precomputed full-resolution masks can be passed to skip the masking pass.
+    """
+    red_pixel_area, non_tissue_area, total_area, percentage, masks = count_hsv_pixels(
+        img_hsv, HSV_RANGES, masks)
+    preview_size = (preview.shape[1], preview.shape[0])
+    preview_masks = {color: cv2.resize(mask, preview_size, interpolation=cv2.INTER_NEAREST)
+                     for color, mask in masks.items()}
+    images = build_images(preview, preview_hsv, preview_masks)
 
     print(f"RED PIXELS: {red_pixel_area}")
     print(f"NON-TISSUE PIXELS: {non_tissue_area}")
     print(f"TOTAL PIXELS: {total_area}")
     print(f"PERCENT RED: {percentage}")
-    return images
+    return red_pixel_area, non_tissue_area, total_area, percentage, images
+
+
+class PreviewWorker:
+    """
+    Loads images and computes previews on a background thread so the window never waits on them.
+    Only the latest request is kept: a newer request replaces one still waiting, and a preview
+    being computed is abandoned between stages once it is stale. Finished previews are put on
+    results as (generation, result) for the UI thread to draw.
+    """
+
+    def __init__(self):
+        self.results = queue.Queue()
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+        # Loaded image and mask caches, only touched by the worker thread
+        self.image = None
+        self.range_masks = {}
+        self.combined_masks = None
+        self.combined_keys = None
+        # Image loaded by a request that went stale, handed over with the next result
+        self.loaded = None
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, HSV_RANGES, path=None):
+        """
+        Requests a preview for the current ranges, after loading path if given. Returns the
+        generation the result will carry.
+        """
+        with self.condition:
+            self.generation += 1
+            # A load that has not started yet is carried over by the request replacing it
+            if path is None and self.request is not None:
+                path = self.request['path']
+            self.request = {
+                'generation': self.generation,
+                'path': path,
+                'hsv_ranges': {mask_type: list(ranges) for mask_type, ranges in HSV_RANGES.items()},
+            }
+            self.condition.notify()
+            return self.generation
+
+    def stale(self, request):
+        return request['generation'] != self.generation
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                request, self.request = self.request, None
+            try:
+                self.compute(request)
+            except Exception as e:
+                self.results.put((request['generation'], {'error': e}))
+
+    def compute(self, request):
+        if request['path'] is not None:
+            self.load(request['path'])
+        if self.image is None or self.stale(request):
+            return
+
+        masks = self.update_masks(request['hsv_ranges'])
+        if self.stale(request):
+            return
+        image = self.image
+        *counts, images = count_preview(request['hsv_ranges'], image['hsv'], image['preview'],
+                                        image['preview_hsv'], masks)
+        if self.stale(request):
+            return
+
+        self.results.put((request['generation'], {'counts': counts, 'images': images, 'image': self.loaded}))
+        self.loaded = None
+
+    def load(self, path):
+        img = cv2.imread(path)
+        if img is None:
+            raise ValueError(f"Could not read image {path}")
+        # Convert once per image; mask edits only redo the masking and counting
+        preview = build_preview(img)
+        self.image = {
+            'path': path,
+            'img': img,
+            'rgb': cv2.cvtColor(img, cv2.COLOR_BGR2RGB),
+            'hsv': cv2.cvtColor(img, cv2.COLOR_BGR2HSV),
+            'preview': preview,
+            'preview_hsv': cv2.cvtColor(preview, cv2.COLOR_BGR2HSV),
+        }
+        self.loaded = self.image
+        self.range_masks.clear()
+        self.combined_masks = None
+
+    def range_mask(self, key, color_range):
+        if key not in self.range_masks:
+            self.range_masks[key] = cv2.inRange(self.image['hsv'], color_range['lower'], color_range['upper'])
+        return self.range_masks[key]
+
+    def update_masks(self, HSV_RANGES):
+        """
+        Brings the combined red and white masks in line with HSV_RANGES. Ranges appended since the
+        last preview cost one inRange pass OR-ed into their mask, even across abandoned requests;
+        any other change recombines the cached range masks.
+        """
+        keys = {mask_type: [range_key(mask_type, color_range) for color_range in color_ranges]
+                for mask_type, color_ranges in HSV_RANGES.items()}
+        appended = self.combined_masks is not None and all(
+            keys[mask_type][:len(self.combined_keys[mask_type])] == self.combined_keys[mask_type]
+            for mask_type in keys)
+        if not appended:
+            self.combined_masks = {mask_type: np.zeros(self.image['hsv'].shape[:2], dtype=np.uint8)
+                                   for mask_type in keys}
+            self.combined_keys = {mask_type: [] for mask_type in keys}
+
+        for mask_type, color_ranges in HSV_RANGES.items():
+            for key, color_range in list(zip(keys[mask_type], color_ranges))[len(self.combined_keys[mask_type]):]:
+                cv2.bitwise_or(self.combined_masks[mask_type], self.range_mask(key, color_range),
+                               dst=self.combined_masks[mask_type])
+        self.combined_keys = keys
+
+        # Drop masks of ranges that were removed
+        current_keys = {key for mask_keys in keys.values() for key in mask_keys}
+        for key in set(self.range_masks) - current_keys:
+            del self.range_masks[key]
+        return self.combined_masks
+
+
+def range_key(mask_type, color_range):
+    return (mask_type, tuple(color_range['lower']), tuple(color_range['upper']))
 
 
 def draw_plot(fig, path, red_pixel_area, non_tissue_area, total_area, percentage, images):
@@ -49,6 +194,8 @@ def draw_plot(fig, path, red_pixel_area, non_tissue_area, total_area, percentage
 
 
 def plot_image(image, text, plot, gray=False):
+    import matplotlib.pyplot as plt
+
     ax = plt.subplot(plot)
     ax.title.set_text(text)
     ax.xaxis.set_visible(False)
@@ -58,6 +205,13 @@ def plot_image(image, text, plot, gray=False):
 
 
 def setup_window(image_path=None):
+    import matplotlib
+    matplotlib.use('TkAgg')
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    import customtkinter as ctk
+    from tkinter import filedialog, messagebox
+
     HSV_RANGES = {
         'red': [],
         'white': []
@@ -67,7 +221,15 @@ def setup_window(image_path=None):
     last_clicked_rgb = None
     last_clicked_hsv = None
     img = None
+    img_rgb = None
+    img_hsv = None
+    preview = None
     current_image_path = None
+    # Previews are computed in the background; only the latest generation is drawn
+    preview_worker = PreviewWorker()
+    preview_generation = 0
+    preview_after_id = None
+    debounce_after_id = None
 
     ctk.set_appearance_mode("dark")
     ctk.set_default_color_theme("dark-blue")
@@ -91,10 +253,7 @@ def setup_window(image_path=None):
     figure_canvas.get_tk_widget().grid(row=0, column=0, sticky="nsew")
 
     def initialize_with_image(path):
-        nonlocal img, images, current_image_path
-        current_image_path = path
-        img = cv2.imread(path)
-        update_plot()
+        submit_preview(path)
 
     def load_image():
         image_path = filedialog.askopenfilename(initialdir=os.getcwd(), filetypes=[("Image files", "*.jpg *.jpeg *.png *.tif *.tiff")])
@@ -119,16 +278,16 @@ def setup_window(image_path=None):
     def on_click(event):
         nonlocal last_clicked_rgb, last_clicked_hsv
         if event.inaxes and event.inaxes.get_title() in ["Original image", "HSV image"]:
-            x, y = int(event.xdata), int(event.ydata)
+            # The panels show the preview, so map the click back to the full-resolution pixel
+            x = min(int(event.xdata * img.shape[1] / preview.shape[1]), img.shape[1] - 1)
+            y = min(int(event.ydata * img.shape[0] / preview.shape[0]), img.shape[0] - 1)
             
             # Store RGB for the swatch
-            rgb_img = images[ORIGINAL]
-            r, g, b = rgb_img[y, x]
+            r, g, b = img_rgb[y, x]
             last_clicked_rgb = (r,g,b)
             
             # Store HSV for range calculation
-            hsv_img = images[HSV]
-            h, s, v = hsv_img[y, x]
+            h, s, v = img_hsv[y, x]
             last_clicked_hsv = (int(h), int(s), int(v))
 
             # Update the color swatch
@@ -138,14 +297,49 @@ def setup_window(image_path=None):
 
     fig.canvas.mpl_connect('button_press_event', on_click)
 
+    def submit_preview(path=None):
+        nonlocal preview_generation, debounce_after_id
+        # This request covers any edit still waiting out the debounce
+        if debounce_after_id is not None:
+            root.after_cancel(debounce_after_id)
+            debounce_after_id = None
+        preview_generation = preview_worker.submit(HSV_RANGES, path)
+
     def update_plot():
-        nonlocal images
-        if img is None:
-            fig.clear()
-            figure_canvas.draw()
-            return
-        images = count_pixels_and_plot(current_image_path, fig, HSV_RANGES, img)
-        figure_canvas.draw()
+        """
+        Schedules a preview of the current ranges. Edits in quick succession restart the wait, so
+        only the last of them is computed.
+        """
+        nonlocal debounce_after_id
+        if debounce_after_id is not None:
+            root.after_cancel(debounce_after_id)
+        debounce_after_id = root.after(PREVIEW_DEBOUNCE_MS, submit_preview)
+
+    def check_preview():
+        """
+        Takes finished previews from the worker on the UI thread and draws the latest one;
+        previews overtaken by a newer request are dropped.
+        """
+        nonlocal img, img_rgb, img_hsv, preview, current_image_path, images, preview_after_id
+        while True:
+            try:
+                generation, result = preview_worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if 'error' in result:
+                # Errors of abandoned requests are as stale as their previews
+                if generation == preview_generation:
+                    messagebox.showerror("Preview", str(result['error']))
+                continue
+            loaded = result['image']
+            if loaded is not None:
+                current_image_path = loaded['path']
+                img, img_rgb, img_hsv, preview = loaded['img'], loaded['rgb'], loaded['hsv'], loaded['preview']
+            if generation == preview_generation:
+                images = result['images']
+                draw_plot(fig, current_image_path, *result['counts'], images)
+                figure_canvas.draw()
+        preview_after_id = root.after(PREVIEW_POLL_MS, check_preview)
 
     def add_color_to_mask():
         if last_clicked_hsv is None:
@@ -347,10 +541,42 @@ def setup_window(image_path=None):
     output_format = ctk.StringVar(value=".png")
     ctk.CTkOptionMenu(format_frame, variable=output_format, values=[".png", ".jpg", ".tif"]).pack(side='right', padx=5)
 
+    # Input image selection for batches
+    input_frame = ctk.CTkFrame(sliders_frame)
+    input_frame.pack(pady=10, padx=10, fill='x')
+    ctk.CTkLabel(input_frame, text="Batch Input Format:").pack(side='left', padx=5)
+    input_format = ctk.StringVar(value=".jpg")
+    ctk.CTkOptionMenu(input_frame, variable=input_format, values=[".jpg", ".tif", ".png", "all"]).pack(side='right', padx=5)
+    include_subfolders = ctk.BooleanVar(value=False)
+    ctk.CTkCheckBox(sliders_frame, text="Include Subfolders", variable=include_subfolders).pack(pady=5, padx=10, anchor='w')
+
+    # Summary plot renderer selection
+    renderer_frame = ctk.CTkFrame(sliders_frame)
+    renderer_frame.pack(pady=10, padx=10, fill='x')
+    ctk.CTkLabel(renderer_frame, text="Summary Plot:").pack(side='left', padx=5)
+    plot_renderer = ctk.StringVar(value="matplotlib")
+    ctk.CTkOptionMenu(renderer_frame, variable=plot_renderer, values=PLOT_RENDERERS).pack(side='right', padx=5)
+
+    # Review artifact selection: six full-size images or one compact mask archive per image
+    artifacts_frame = ctk.CTkFrame(sliders_frame)
+    artifacts_frame.pack(pady=10, padx=10, fill='x')
+    ctk.CTkLabel(artifacts_frame, text="Review Images:").pack(side='left', padx=5)
+    artifact_format = ctk.StringVar(value="images")
+    ctk.CTkOptionMenu(artifacts_frame, variable=artifact_format, values=ARTIFACT_FORMATS).pack(side='right', padx=5)
+
     after_id = None
+    # Long-lived worker pools, started on the first batch and reused by later ones
+    engine = None
+    batch_cancelled = False
+
+    def get_engine():
+        nonlocal engine
+        if engine is None:
+            engine = BatchEngine()
+        return engine
 
     def batch_process():
-        nonlocal after_id
+        nonlocal after_id, batch_cancelled
         input_dir = filedialog.askdirectory(initialdir=os.getcwd(), title="Select Input Folder with Images")
         if not input_dir:
             return
@@ -379,19 +605,33 @@ def setup_window(image_path=None):
         with open(f"{output_dir}/image_settings.json", 'w') as f:
             json.dump(settings, f, indent=4)
 
-        image_files = [f for f in os.listdir(input_dir) if f.endswith('.jpg')]
+        recursive = include_subfolders.get()
+        if recursive and is_within(output_dir, input_dir):
+            messagebox.showwarning("Batch Processing", "Choose a destination outside the input folder when including subfolders.")
+            return
+
+        # Scan once; the batch reads the manifest instead of scanning the folder again
+        image_formats = IMAGE_FORMATS if input_format.get() == "all" else [input_format.get()]
+        image_files = discover_images(input_dir, image_formats, recursive)
+        manifest_path = os.path.join(output_dir, MANIFEST_CSV)
+        write_manifest(manifest_path, image_files)
         file_count = len(image_files)
         
         if file_count == 0:
-            messagebox.showwarning("Batch Processing", "No .jpg files found in the input folder.")
+            messagebox.showwarning("Batch Processing", f"No {' or '.join(image_formats)} files found in the input folder.")
             return
 
-        manager = Manager()
-        progress_queue = manager.Queue()
+        batch_engine = get_engine()
+        progress_queue = batch_engine.manager.Queue()
+        batch_cancelled = False
 
-        thread = threading.Thread(target=run_analyzer, args=(input_dir, ".jpg", True, output_dir, HSV_RANGES, progress_queue, save_ext))
+        thread = threading.Thread(target=run_analyzer, args=(input_dir, image_formats, True, output_dir, HSV_RANGES, progress_queue, save_ext),
+                                  kwargs={'plot_renderer': plot_renderer.get(), 'artifact_format': artifact_format.get(),
+                                          'engine': batch_engine, 'recursive': recursive, 'manifest_path': manifest_path})
         thread.daemon = True
         thread.start()
+        batch_button.configure(state="disabled")
+        cancel_button.configure(state="normal")
 
         def check_queue():
             nonlocal after_id
@@ -399,28 +639,41 @@ def setup_window(image_path=None):
                 progress = progress_queue.qsize() / file_count
                 progress_bar.set(progress)
                 progress_label.configure(text=f"{int(progress * 100)}%")
-                if progress < 1:
+                if thread.is_alive():
                     after_id = root.after(100, check_queue)
                 else:
                     progress_bar.set(0) # Reset after completion
                     progress_label.configure(text="0%")
-                    messagebox.showinfo("Batch Processing", "Batch processing complete!")
+                    batch_button.configure(state="normal")
+                    cancel_button.configure(state="disabled")
+                    if batch_cancelled:
+                        messagebox.showinfo("Batch Processing", "Batch processing cancelled.")
+                    else:
+                        messagebox.showinfo("Batch Processing", "Batch processing complete!")
             except Exception:
                 # Handle potential errors during closing when root might be destroyed
                 pass
         
         check_queue()
 
+    def cancel_batch():
+        nonlocal batch_cancelled
+        if engine is not None:
+            batch_cancelled = True
+            engine.cancel()
+
     def on_closing():
         nonlocal after_id
-        if after_id:
-            try:
-                root.after_cancel(after_id)
-            except Exception:
-                pass
+        for pending_id in [after_id, preview_after_id, debounce_after_id]:
+            if pending_id:
+                try:
+                    root.after_cancel(pending_id)
+                except Exception:
+                    pass
+        if engine is not None:
+            engine.close()
         root.quit()
         root.destroy()
-        os._exit(0)
 
     root.protocol("WM_DELETE_WINDOW", on_closing)
 
@@ -429,6 +682,8 @@ def setup_window(image_path=None):
     batch_frame.pack(pady=10, padx=10, fill='x')
     batch_button = ctk.CTkButton(batch_frame, text="Batch Process", command=batch_process)
     batch_button.pack(fill='x', pady=5)
+    cancel_button = ctk.CTkButton(batch_frame, text="Cancel Batch", command=cancel_batch, state="disabled")
+    cancel_button.pack(fill='x', pady=5)
     
     progress_frame = ctk.CTkFrame(batch_frame)
     progress_frame.pack(fill='x', pady=5)
@@ -438,6 +693,7 @@ def setup_window(image_path=None):
     progress_label = ctk.CTkLabel(progress_frame, text="0%")
     progress_label.pack(side='right')
 
+    check_preview()
     if image_path:
         initialize_with_image(image_path)
     
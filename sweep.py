@@ -0,0 +1,196 @@
+import argparse
+import itertools
+import json
+import uuid
+from multiprocessing import Pool, cpu_count
+from os import path
+
+import cv2
+import numpy as np
+
+from analyzer import (
+    MAX_CHUNKSIZE,
+    TILE_ROWS,
+    batch_settings,
+    compile_hsv_ranges,
+    compute_hsv_histogram,
+    count_histogram,
+    discover_images,
+    init_worker,
+    load_settings,
+)
+
+SWEEP_CSV = "PSR_sweep.csv"
+SWEEP_COLUMNS = [
+    "filename",
+    "variant",
+    "red_h_tolerance",
+    "red_s_tolerance",
+    "red_v_tolerance",
+    "white_h_tolerance",
+    "white_s_tolerance",
+    "white_v_tolerance",
+    "red_pixel_count",
+    "non_tissue_pixel_count",
+    "total_pixel_count",
+    "percent_red",
+]
+
+
+def range_center(color_range):
+    """
+    Returns the HSV color a range was built around: the clicked color saved by the GUI, or the
+    middle of the range for settings without one.
+    """
+    if "rgb" in color_range:
+        rgb = np.array([[color_range["rgb"]]], dtype=np.uint8)
+        return [int(c) for c in cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)[0, 0]]
+
+    return [(int(lo) + int(hi)) // 2 for lo, hi in zip(color_range["lower"], color_range["upper"])]
+
+
+def ranges_with_tolerances(settings, tolerances):
+    """
+    Rebuilds every range of a settings dict around its center with new H/S/V tolerances per
+    mask, the same way the GUI's Add Color does. tolerances maps "red"/"white" to (h, s, v).
+    """
+    hsv_ranges = dict()
+    for mask_type, color_ranges in settings["hsv_ranges"].items():
+        h_tolerance, s_tolerance, v_tolerance = tolerances[mask_type]
+        hsv_ranges[mask_type] = []
+        for color_range in color_ranges:
+            h, s, v = range_center(color_range)
+            lower = np.array([max(0, h - h_tolerance), max(0, s - s_tolerance), max(0, v - v_tolerance)])
+            upper = np.array([min(255, h + h_tolerance), min(255, s + s_tolerance), min(255, v + v_tolerance)])
+            hsv_ranges[mask_type].append({"lower": lower, "upper": upper})
+
+    return hsv_ranges
+
+
+def tolerance_variants(settings, grid):
+    """
+    Expands a grid of tolerances into (name, tolerances, hsv_ranges) variants.
+    grid maps "red_h", "red_s", ... "white_v" to lists of values; missing keys keep the
+    tolerances saved in the settings.
+    """
+    axes = []
+    for mask_type in ["red", "white"]:
+        for channel in ["h", "s", "v"]:
+            saved = int(settings[f"{mask_type}_tolerances"][channel])
+            axes.append(grid.get(f"{mask_type}_{channel}") or [saved])
+
+    variants = []
+    for values in itertools.product(*axes):
+        tolerances = {"red": values[:3], "white": values[3:]}
+        name = "red={},{},{};white={},{},{}".format(*values)
+        variants.append((name, values, ranges_with_tolerances(settings, tolerances)))
+
+    return variants
+
+
+def sweep_image_worker(task):
+    """
+    Decodes one image once, as an HSV histogram, and counts it under every variant.
+    """
+    batch_id, filename = task
+    settings = batch_settings(batch_id)
+    print(f"Processing {filename}")
+    codes, counts = compute_hsv_histogram(
+        path.join(settings["path_to_img_dir"], filename), settings["tile_rows"]
+    )
+
+    return [
+        [filename, name, *tolerances, *count_histogram(codes, counts, hsv_ranges)]
+        for name, tolerances, hsv_ranges in settings["variants"]
+    ]
+
+
+def sweep(
+    path_to_img_dir, image_format, variants, output_csv=None, tile_rows=TILE_ROWS, processes=None
+):
+    """
+    Evaluates many settings variants over a folder in a single pass, decoding each image once.
+    variants is a list of (name, tolerances, hsv_ranges), where tolerances is the 6-tuple of
+    red and white H/S/V tolerances or None. Writes a long-format table with one row per image
+    per variant to PSR_sweep.csv in the images folder unless output_csv is given.
+    processes sets the number of worker processes (default: one per core).
+    """
+    variants = [
+        (name, tolerances if tolerances is not None else [None] * 6, compile_hsv_ranges(hsv_ranges))
+        for name, tolerances, hsv_ranges in variants
+    ]
+    onlyfiles = [filename for filename, _, _ in discover_images(path_to_img_dir, image_format)]
+
+    batch_id = uuid.uuid4().hex
+    batch = {"path_to_img_dir": path_to_img_dir, "tile_rows": tile_rows, "variants": variants}
+    processes = processes or cpu_count()
+    chunksize = max(1, min(MAX_CHUNKSIZE, len(onlyfiles) // (4 * processes)))
+    with Pool(processes, initializer=init_worker, initargs=({batch_id: batch},)) as pool:
+        rows = [
+            row
+            for image_rows in pool.imap_unordered(
+                sweep_image_worker, [(batch_id, f) for f in onlyfiles], chunksize
+            )
+            for row in image_rows
+        ]
+
+    import pandas as pd
+
+    df = pd.DataFrame(rows, columns=SWEEP_COLUMNS).sort_values(["filename", "variant"])
+    df.to_csv(output_csv if output_csv else path.join(path_to_img_dir, SWEEP_CSV), index=False)
+    print("Done!")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(
+        description="Evaluate a grid of mask tolerances or settings files over a folder of images"
+    )
+    ap.add_argument("-p", "--path", help="path to the images folder", required=True)
+    ap.add_argument("-x", "--ext", nargs="+", help="image file extensions", default=[".tif"])
+    ap.add_argument("-s", "--settings", help="base settings JSON saved by the GUI")
+    ap.add_argument("-o", "--output", help="output CSV (default: PSR_sweep.csv in --path)")
+    for mask_type in ["red", "white"]:
+        for channel in ["h", "s", "v"]:
+            ap.add_argument(
+                f"--{mask_type}-{channel}",
+                type=int,
+                nargs="+",
+                help=f"{mask_type} mask {channel.upper()} tolerances to try",
+            )
+    ap.add_argument(
+        "--variants",
+        nargs="+",
+        default=[],
+        help="additional settings JSON files to evaluate as-is",
+    )
+    ap.add_argument(
+        "--tile-rows",
+        type=int,
+        default=TILE_ROWS,
+        help="decode images in strips of this many rows to bound memory",
+    )
+    ap.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        help="number of worker processes (default: one per core)",
+    )
+    args = vars(ap.parse_args())
+
+    variants = []
+    if args["settings"]:
+        with open(args["settings"]) as f:
+            base_settings = json.load(f)
+        grid = {
+            f"{mask_type}_{channel}": args[f"{mask_type}_{channel}"]
+            for mask_type in ["red", "white"]
+            for channel in ["h", "s", "v"]
+        }
+        variants += tolerance_variants(base_settings, grid)
+    variants += [(path.basename(f), None, load_settings(f)) for f in args["variants"]]
+    if not variants:
+        ap.error("give a base --settings file and/or --variants")
+
+    sweep(
+        args["path"], args["ext"], variants, args["output"], args["tile_rows"], args["processes"]
+    )